@@ -0,0 +1,46 @@
+"""Runs work in the background while the bazel log is being scanned.
+
+Fixers submit work here (e.g. loading an index, or reading a source file) as
+soon as the scanner finds an error they might fix, so that it overlaps with
+the rest of the scan. All work runs on a single worker thread, in the order
+it was submitted, and post_bazel waits for it to finish before applying any
+fixes. This means that background work never runs concurrently with fixes,
+or with other background work.
+"""
+
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Union
+
+import metrics
+import tracing
+from common import warn
+from config import DEBUG
+
+_EXECUTOR: Union[ThreadPoolExecutor, None] = None
+_FUTURES: List[Future] = []
+
+
+def submit(func: Callable, *args) -> Future:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(max_workers=1)
+    tracing.count("background_tasks")
+    future = _EXECUTOR.submit(func, *args)
+    _FUTURES.append(future)
+    return future
+
+
+def wait():
+    """Waits for all submitted work to finish.
+
+    Errors are left for whoever uses the result to handle. Prefetch errors are
+    only reported in debug mode.
+    """
+    with metrics.phase("wait_for_background_work"):
+        for future in _FUTURES:
+            e = future.exception()
+            if e is not None and DEBUG:
+                lines = traceback.format_exception(type(e), e, e.__traceback__)
+                warn("Background task failed:\n" + "".join(lines))
+    _FUTURES.clear()
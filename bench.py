@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""Benchmarks for the hot paths of the plugin.
+
+Generates synthetic git repos and bazel logs, so it runs offline and without
+bazel. Results are written as JSON so that they can be compared between
+commits:
+
+    python3 bench.py --output before.json
+    git checkout my-branch
+    python3 bench.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STDLIB_PACKAGES = ["context", "fmt", "io", "os", "sort", "strings", "sync", "time"]
+
+ANSI_NOISE_LINES = [
+    "\x1b[32mINFO: \x1b[0mFrom Compiling {pkg}:\n",
+    "\r\x1b[1A\x1b[K\x1b[32m[{n} / 12,345]\x1b[0m GoCompilePkg {pkg}/{pkg}.a; 3s "
+    "linux-sandbox ... (8 actions running)\n",
+    "\x1b[35mWARNING: \x1b[0mdownload of {pkg} failed; retrying\n",
+    "INFO: Analyzed 1,234 targets (567 packages loaded, 8,910 targets configured).\n",
+]
+
+
+def git(repo: str, *args: str):
+    subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@bench", *args],
+        cwd=repo,
+        check=True,
+        capture_output=True,
+    )
+
+
+def write_file(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def package_url(module: str, i: int) -> str:
+    return f"{module}/server/pkg{i}"
+
+
+def render_go_file(package: str, imports: List[str]) -> str:
+    lines = [f"package {package}\n", "\n", "import (\n"]
+    for url in imports:
+        lines.append(f'\t"{url}"\n')
+    lines.append(")\n\n")
+    lines.extend(f"var _ = {i}\n" for i in range(50))
+    return "".join(lines)
+
+
+def generate_repo(
+    path: str, module: str, num_files: int, files_per_package: int, rng
+) -> List[str]:
+    """Generates a git repo with Go packages and BUILD files.
+
+    Returns the repo-relative paths of the generated Go files.
+    """
+    num_packages = max(1, num_files // files_per_package)
+    go_paths = []
+    for p in range(num_packages):
+        pkg_dir = f"server/pkg{p}"
+        srcs = []
+        for f in range(files_per_package):
+            name = f"file{f}.go"
+            imports = rng.sample(STDLIB_PACKAGES, 3) + [
+                package_url(module, rng.randrange(num_packages)) for _ in range(5)
+            ]
+            write_file(
+                os.path.join(path, pkg_dir, name),
+                render_go_file(f"pkg{p}", sorted(set(imports))),
+            )
+            srcs.append(name)
+            go_paths.append(f"{pkg_dir}/{name}")
+        srcs_list = "".join(f'        "{src}",\n' for src in srcs)
+        write_file(
+            os.path.join(path, pkg_dir, "BUILD"),
+            "go_library(\n"
+            f'    name = "pkg{p}",\n'
+            f"    srcs = [\n{srcs_list}    ],\n"
+            f'    importpath = "{package_url(module, p)}",\n'
+            ")\n",
+        )
+    git(path, "init", "-q")
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "synthetic repo")
+    return go_paths
+
+
+def generate_log(
+    path: str, go_paths: List[str], size_bytes: int, error_rate: float, rng
+):
+    """Generates a failed bazel log with ANSI noise and a mix of errors."""
+    error_lines = [
+        lambda p: f'{p}:4:2: "os" imported and not used\n',
+        lambda p: f"{p}:60:5: undefined: pkg1\n",
+        lambda p: f"{p}:7:1: syntax error: unexpected {{ in type declaration\n",
+        lambda p: "app/foo/foo.tsx:3:5 - error TS2304: Cannot find name 'router'.\n",
+        lambda p: (
+            "app/foo/foo.tsx:1:1 - error TS2307: [strictDeps] transitive "
+            "dependency on bazel-out/k8-fastbuild/bin/app/bar/bar.d.ts not allowed.\n"
+        ),
+    ]
+    written = 0
+    n = 0
+    with open(path, "w") as f:
+        while written < size_bytes:
+            n += 1
+            if rng.random() < error_rate:
+                line = rng.choice(error_lines)(rng.choice(go_paths))
+            else:
+                line = rng.choice(ANSI_NOISE_LINES).format(pkg=f"pkg{n % 100}", n=n)
+            f.write(line)
+            written += len(line)
+        f.write("\x1b[31m\x1b[1mERROR: \x1b[0mBuild did NOT complete successfully\n")
+
+
+def time_runs(func: Callable[[], Any], repeat: int, setup=None) -> Dict[str, Any]:
+    durations = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {
+        "runs": repeat,
+        "min_s": min(durations),
+        "median_s": statistics.median(durations),
+        "mean_s": statistics.mean(durations),
+    }
+
+
+def plugin_commit() -> str:
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=PLUGIN_DIR, capture_output=True, text=True
+    )
+    return result.stdout.strip()
+
+
+def run_benchmarks(args, tmp: str) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    oss_path = os.path.join(tmp, "buildbuddy")
+    internal_path = os.path.join(tmp, "buildbuddy-internal")
+    go_paths = generate_repo(
+        oss_path, "github.com/example/oss", args.files, args.files_per_package, rng
+    )
+    generate_repo(
+        internal_path,
+        "github.com/example/internal",
+        args.files,
+        args.files_per_package,
+        rng,
+    )
+    log_path = os.path.join(tmp, "bazel.log")
+    generate_log(log_path, go_paths, args.log_mb << 20, args.error_rate, rng)
+
+    # The plugin modules read their configuration from the environment at
+    # import time, so they can only be imported once it's set up.
+    os.environ["BUILDBUDDY_REPO_PATH"] = oss_path
+    os.environ["BUILDBUDDY_INTERNAL_REPO_PATH"] = internal_path
+    os.environ["BUILD_WORKSPACE_DIRECTORY"] = oss_path
+    os.environ["BB_DEV_PLUGINS_CACHE_DIR"] = os.path.join(tmp, "cache")
+    # Don't pick up the user's workspaces config.
+    os.environ["BB_DEV_PLUGINS_WORKSPACES"] = os.path.join(tmp, "workspaces.json")
+    sys.path.insert(0, PLUGIN_DIR)
+    import common
+    import go
+    import post_bazel
+    import repo_index
+    import workspace
+
+    results = {}
+
+    results["build_import_index"] = time_runs(go.build_import_index, args.repeat)
+    results["build_import_index_parallel"] = time_runs(
+        go.build_import_index_parallel, args.repeat
+    )
+
+    def clear_import_indexes():
+        repo_index.reset_repo_indexes()
+        index_dir = os.path.join(tmp, "cache", "go_import_index")
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+    results["load_import_index_cold"] = time_runs(
+        go.load_import_index, args.repeat, setup=clear_import_indexes
+    )
+    results["load_import_index_warm_disk"] = time_runs(
+        go.load_import_index, args.repeat, setup=repo_index.reset_repo_indexes
+    )
+    results["load_import_index_warm_memory"] = time_runs(
+        go.load_import_index, args.repeat
+    )
+
+    def scan_log():
+        with open(log_path, "rb") as f:
+            post_bazel.scan_log(f)
+
+    def build_status_from_summary():
+        with open(log_path, "rb") as f:
+            post_bazel.build_status_from_summary(f)
+
+    results["scan_log"] = time_runs(scan_log, args.repeat)
+    results["build_status_from_summary"] = time_runs(
+        build_status_from_summary, args.repeat
+    )
+
+    execroot = "/home/user/.cache/bazel/_bazel_user/0123abcd/execroot"
+    execroot_paths = [f"{execroot}/buildbuddy/{path}" for path in go_paths]
+
+    def get_source_file_info():
+        for path in execroot_paths:
+            workspace.get_source_file_info(path)
+
+    results["get_source_file_info"] = time_runs(
+        get_source_file_info, args.repeat, setup=workspace.reset_BUILD_targets
+    )
+    results["get_source_file_info"]["paths"] = len(execroot_paths)
+
+    big_file = os.path.join(tmp, "big_imports.go")
+    big_imports = [f"github.com/example/big/pkg{i}" for i in range(args.imports)]
+
+    def write_big_file():
+        write_file(big_file, render_go_file("big", big_imports))
+        common.reset_source_files()
+
+    def add_import():
+        go.add_import(big_file, "github.com/example/added", alias="addedpb")
+        common.apply_edits()
+
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            results["add_import"] = time_runs(
+                add_import, args.repeat, setup=write_big_file
+            )
+        finally:
+            sys.stdout = stdout
+    results["add_import"]["imports"] = args.imports
+
+    return results
+
+
+# Runs load_import_index with an empty cache in a fresh process, and prints
+# its max RSS in KiB before and after. On Linux, ru_maxrss starts out at the
+# parent's RSS when it forked, which hides anything smaller, so VmHWM (which
+# only covers this process) is used instead.
+PEAK_RSS_SCRIPT = """
+import resource, sys
+sys.path.insert(0, sys.argv[1])
+import go
+
+def peak_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and KiB elsewhere.
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+before = peak_rss_kb()
+go.load_import_index()
+print(before, peak_rss_kb())
+"""
+
+# Packages per repo in the peak RSS benchmark. This is fixed so that the
+# counts in the index are the same size for every repo size, and only memory
+# proportional to the number of files shows up as growth.
+MEMORY_PACKAGES = 10
+
+
+def measure_index_peak_rss(args, tmp: str) -> List[Dict[str, Any]]:
+    """Measures the peak RSS of loading the import index with an empty cache
+    for increasingly large repos."""
+    results = []
+    for size in args.memory_sizes:
+        rng = random.Random(args.seed + size)
+        root = os.path.join(tmp, f"memory_{size}")
+        oss_path = os.path.join(root, "buildbuddy")
+        internal_path = os.path.join(root, "buildbuddy-internal")
+        files_per_package = max(1, size // MEMORY_PACKAGES)
+        for path, module in (
+            (oss_path, "github.com/example/oss"),
+            (internal_path, "github.com/example/internal"),
+        ):
+            generate_repo(path, module, size, files_per_package, rng)
+        env = dict(
+            os.environ,
+            BUILDBUDDY_REPO_PATH=oss_path,
+            BUILDBUDDY_INTERNAL_REPO_PATH=internal_path,
+            BUILD_WORKSPACE_DIRECTORY=oss_path,
+            BB_DEV_PLUGINS_CACHE_DIR=os.path.join(root, "cache"),
+            BB_DEV_PLUGINS_WORKSPACES=os.path.join(root, "workspaces.json"),
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", PEAK_RSS_SCRIPT, PLUGIN_DIR],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        before, after = (int(value) for value in output.split())
+        results.append(
+            {
+                "files": 2 * size,
+                "baseline_rss_kb": before,
+                "peak_rss_kb": after,
+                "index_build_rss_kb": after - before,
+            }
+        )
+    # Memory which grows with the number of files (e.g. their paths) shows up
+    # as growth relative to the smallest repo. It should stay small.
+    for result in results[1:]:
+        files = result["files"] - results[0]["files"]
+        rss_kb = result["index_build_rss_kb"] - results[0]["index_build_rss_kb"]
+        result["growth_bytes_per_file"] = rss_kb * 1024 // files if files else 0
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]):
+    base_memory = {m["files"]: m for m in baseline.get("memory", [])}
+    for memory in results["memory"]:
+        base = base_memory.get(memory["files"])
+        if base:
+            sys.stderr.write(
+                f"{'index_build_rss @ %d files' % memory['files']:32}"
+                f" {base['index_build_rss_kb']:8d}K -> "
+                f"{memory['index_build_rss_kb']:8d}K\n"
+            )
+        if base and "growth_bytes_per_file" in memory:
+            sys.stderr.write(
+                f"{'rss_growth @ %d files' % memory['files']:32}"
+                f" {base.get('growth_bytes_per_file', 0):8d}B -> "
+                f"{memory['growth_bytes_per_file']:8d}B per file\n"
+            )
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        ratio = result["median_s"] / base["median_s"] if base["median_s"] else 0
+        sys.stderr.write(
+            f"{name:32} {base['median_s']:9.4f}s -> {result['median_s']:9.4f}s"
+            f"  ({ratio:.2f}x)\n"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=2000, help="Go files per repo")
+    parser.add_argument("--files_per_package", type=int, default=10)
+    parser.add_argument("--log_mb", type=int, default=16, help="bazel log size")
+    parser.add_argument(
+        "--error_rate", type=float, default=0.001, help="fraction of error lines"
+    )
+    parser.add_argument("--imports", type=int, default=500, help="for add_import")
+    parser.add_argument(
+        "--memory_sizes",
+        type=lambda value: [int(size) for size in value.split(",") if size],
+        default="500,1000,2000",
+        help="Go files per repo for the peak RSS benchmark (empty to skip)",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results here (default stdout)")
+    parser.add_argument("--compare", help="baseline JSON results to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {
+            "commit": plugin_commit(),
+            "python": platform.python_version(),
+            "params": vars(args),
+            "results": run_benchmarks(args, tmp),
+            "memory": measure_index_peak_rss(args, tmp),
+        }
+
+    output = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
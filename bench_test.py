@@ -0,0 +1,45 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import bench
+
+BENCH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench.py")
+
+
+def test_bench_smoke(tmp_path):
+    output = tmp_path / "results.json"
+    subprocess.run(
+        [
+            sys.executable,
+            BENCH_PATH,
+            "--files=20",
+            "--log_mb=1",
+            "--imports=20",
+            "--repeat=1",
+            "--memory_sizes=10,20",
+            f"--output={output}",
+        ],
+        check=True,
+        capture_output=True,
+    )
+
+    output = json.loads(output.read_text())
+    results = output["results"]
+    assert "build_import_index" in results
+    assert "scan_log" in results
+    assert all(result["min_s"] >= 0 for result in results.values())
+    assert [m["files"] for m in output["memory"]] == [20, 40]
+    assert all(m["peak_rss_kb"] >= m["baseline_rss_kb"] for m in output["memory"])
+    assert "growth_bytes_per_file" in output["memory"][1]
+
+
+def test_index_peak_rss_is_flat(tmp_path):
+    args = argparse.Namespace(memory_sizes=[500, 4000], seed=0)
+    _, large = bench.measure_index_peak_rss(args, str(tmp_path))
+
+    # Keeping the refs of every file in memory costs ~700 bytes per file,
+    # whereas the list of paths costs under 100.
+    assert large["growth_bytes_per_file"] < 250
@@ -0,0 +1,95 @@
+"""Reads build errors from a Build Event Protocol JSON file.
+
+This is an alternative to scraping the console log: when bazel is run with
+`--build_event_json_file`, failed actions and their stderr, along with the
+overall build status, are available as structured events.
+
+This is imported after every build when enabled, so it follows the import
+rules described at the top of post_bazel.py.
+"""
+
+import json
+import os
+
+import tracing
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Any, BinaryIO, Dict, List, Tuple, Union
+
+# Only events containing one of these are decoded. Progress events, which make
+# up most of the file, are skipped without being parsed.
+EVENT_PREFILTERS = (b'"actionCompleted"', b'"buildFinished"')
+
+# Successful actions are skipped without being parsed, when bazel is run with
+# --build_event_publish_all_actions.
+SUCCESSFUL_ACTION_TOKEN = b'"success":true'
+
+# Exit code of builds which succeeded, but with failing tests. There is nothing
+# to fix in this case.
+TESTS_FAILED_EXIT_CODE = 3
+
+
+def read_build_events(f: "BinaryIO") -> "Union[Tuple[bool, List[str]], None]":
+    """Reads events up to the buildFinished event.
+
+    Returns whether the build failed, along with the stderr lines of failed
+    actions. Returns None if the build didn't finish, or the stderr of a failed
+    action isn't available locally (e.g. it ran remotely), in which case the
+    console log should be scanned instead.
+    """
+    error_lines = []
+    for line in f:
+        if not any(token in line for token in EVENT_PREFILTERS):
+            continue
+        if SUCCESSFUL_ACTION_TOKEN in line:
+            continue
+        tracing.count("build_events_decoded")
+        event = json.loads(line)
+        event_id = event.get("id", {})
+        if "buildFinished" in event_id:
+            finished = event.get("finished", {})
+            exit_code = finished.get("exitCode", {}).get("code", 0)
+            return exit_code not in (0, TESTS_FAILED_EXIT_CODE), error_lines
+        if "actionCompleted" in event_id:
+            action = event.get("action", {})
+            if action.get("success"):
+                continue
+            if "stderr" not in action:
+                continue
+            stderr = read_file(action["stderr"])
+            if stderr is None:
+                tracing.count("build_events_unreadable_stderr")
+                return None
+            error_lines.extend(stderr.splitlines())
+    return None
+
+
+def read_file(file: "Dict[str, Any]") -> "Union[str, None]":
+    """Returns the contents of a BEP File message, if available locally."""
+    if "contents" in file:
+        import base64
+
+        return base64.b64decode(file["contents"]).decode("utf-8", errors="replace")
+    uri = file.get("uri", "")
+    if not uri.startswith("file://"):
+        # e.g. bytestream:// URIs for remotely executed actions, which would
+        # require fetching from the remote cache.
+        return None
+    from urllib.parse import unquote
+
+    try:
+        with open(unquote(uri[len("file://") :]), "rb") as f:
+            return f.read().decode("utf-8", errors="replace")
+    except OSError:
+        return None
+
+
+def is_stale(bep_path: str, bazel_logs_path: str, max_age_s: float) -> bool:
+    """Returns whether the BEP file was written by an earlier command than the
+    one which wrote the log, e.g. one run without --build_event_json_file."""
+    try:
+        bep_mtime = os.path.getmtime(bep_path)
+    except OSError:
+        return True
+    return os.path.getmtime(bazel_logs_path) - bep_mtime > max_age_s
@@ -0,0 +1,85 @@
+import base64
+import io
+import json
+
+import bep
+
+
+def _events(*events):
+    return io.BytesIO(b"".join(json.dumps(e).encode() + b"\n" for e in events))
+
+
+def _progress(stderr):
+    return {"id": {"progress": {"opaqueCount": 1}}, "progress": {"stderr": stderr}}
+
+
+def test_read_build_events(tmp_path):
+    stderr_path = tmp_path / "stderr-1"
+    stderr_path.write_text('server/foo.go:12:3: "os" imported and not used\n')
+    events = _events(
+        {"id": {"started": {}}, "started": {"command": "build"}},
+        _progress("server/noise.go:1:1: not an action error\n"),
+        {
+            "id": {"actionCompleted": {"label": "//server:foo"}},
+            "action": {"success": False, "stderr": {"uri": f"file://{stderr_path}"}},
+        },
+        {
+            "id": {"actionCompleted": {"label": "//app:foo"}},
+            "action": {
+                "success": False,
+                "stderr": {"contents": base64.b64encode(b"a\nb\n").decode()},
+            },
+        },
+        {
+            "id": {"actionCompleted": {"label": "//server:bar"}},
+            "action": {"success": True, "stderr": {"uri": "file:///nonexistent"}},
+        },
+        {
+            "id": {"actionCompleted": {"label": "//nostderr:bar"}},
+            "action": {"success": False},
+        },
+        {
+            "id": {"buildFinished": {}},
+            "finished": {"exitCode": {"name": "BUILD_FAILURE", "code": 1}},
+        },
+        {
+            "id": {"actionCompleted": {"label": "//after:finished"}},
+            "action": {"success": False, "stderr": {"contents": "eA=="}},
+        },
+    )
+
+    assert bep.read_build_events(events) == (
+        True,
+        ['server/foo.go:12:3: "os" imported and not used', "a", "b"],
+    )
+
+
+def test_read_build_events_with_remote_stderr():
+    # The stderr of remotely executed actions would have to be fetched from
+    # the remote cache, so the console log needs to be scanned instead.
+    events = _events(
+        {
+            "id": {"actionCompleted": {"label": "//remote:bar"}},
+            "action": {"success": False, "stderr": {"uri": "bytestream://cache/x"}},
+        },
+        {
+            "id": {"buildFinished": {}},
+            "finished": {"exitCode": {"name": "BUILD_FAILURE", "code": 1}},
+        },
+    )
+    assert bep.read_build_events(events) is None
+
+
+def test_read_build_events_status():
+    def status(finished):
+        events = _events({"id": {"buildFinished": {}}, "finished": finished})
+        return bep.read_build_events(events)
+
+    assert status({"overallSuccess": True, "exitCode": {"name": "SUCCESS"}}) == (
+        False,
+        [],
+    )
+    assert status({"exitCode": {"name": "TESTS_FAILED", "code": 3}}) == (False, [])
+    assert status({"exitCode": {"name": "BUILD_FAILURE", "code": 1}}) == (True, [])
+    # Without a buildFinished event, the console log needs to be scanned.
+    assert bep.read_build_events(_events(_progress("ERROR: killed\n"))) is None
@@ -0,0 +1,111 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Callable, Dict, Iterator, Set
+
+from config import CACHE_DIR
+
+# Directories already made private by this process.
+_PRIVATE_DIRS: Set[str] = set()
+
+
+def cache_path(namespace: str, key: str) -> str:
+    """Returns the path of the cache file for the given namespace and key.
+
+    The key can be any string (e.g. a repo path); it is hashed so that it is
+    safe to use as a file name.
+    """
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, namespace, digest + ".json")
+
+
+def make_private_dirs(path: str):
+    """Creates a directory and any missing parents, accessible only to the
+    owner.
+
+    post_bazel runs with a umask of 0, and the caches decide which imports get
+    added to the owner's files, so they must not be writable by anyone else.
+    Existing directories are restricted too, as far up as CACHE_DIR.
+    """
+    if path in _PRIVATE_DIRS:
+        return
+    missing = []
+    parent = path
+    while not os.path.isdir(parent) and os.path.dirname(parent) != parent:
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+    for directory in reversed(missing):
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+    root = os.path.abspath(CACHE_DIR)
+    directory = os.path.abspath(path)
+    while directory == root or directory.startswith(root + os.sep):
+        if os.stat(directory).st_mode & 0o077:
+            os.chmod(directory, 0o700)
+        directory = os.path.dirname(directory)
+    _PRIVATE_DIRS.add(path)
+
+
+def read_json(path: str) -> Any:
+    """Reads a JSON cache file, returning None if it is missing or corrupt."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path: str, value: Any):
+    """Atomically writes a JSON cache file.
+
+    Concurrent builds may race to update the same cache file, so the value is
+    written to a temp file first and then renamed into place.
+    """
+    make_private_dirs(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def write_json_items(
+    path: str, fields: Dict[str, Any], items_field: str
+) -> Iterator[Callable[[str, Any], None]]:
+    """Atomically writes a JSON cache file like write_json, holding the given
+    fields plus an object under `items_field`.
+
+    Yields a function which writes a single item of that object, so that the
+    items needn't all be held in memory at once. The file is only renamed into
+    place if the block completes.
+    """
+    make_private_dirs(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            # Write everything but the closing braces of the (empty) items
+            # object and the enclosing object.
+            head = json.dumps({**fields, items_field: {}}, separators=(",", ":"))
+            f.write(head[:-2])
+            separator = ""
+
+            def write_item(key: str, value: Any):
+                nonlocal separator
+                f.write(separator + json.dumps(key) + ":")
+                json.dump(value, f, separators=(",", ":"))
+                separator = ","
+
+            yield write_item
+            f.write("}}")
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
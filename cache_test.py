@@ -0,0 +1,32 @@
+import os
+import stat
+
+import cache
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_cache_files_are_private(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir(mode=0o777)
+    os.chmod(tmp_path, 0o755)
+    monkeypatch.setattr(cache, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(cache, "_PRIVATE_DIRS", set())
+    umask = os.umask(0)
+    try:
+        path = cache.cache_path("namespace", "key")
+        cache.write_json(path, {"a": 1})
+        with cache.write_json_items(path + "2", {}, "items") as write_item:
+            write_item("b", [2])
+    finally:
+        os.umask(umask)
+
+    assert cache.read_json(path) == {"a": 1}
+    assert cache.read_json(path + "2") == {"items": {"b": [2]}}
+    assert _mode(cache_dir) == 0o700
+    assert _mode(os.path.dirname(path)) == 0o700
+    assert _mode(path) & 0o077 == 0
+    # Directories outside the cache are left alone.
+    assert _mode(tmp_path) == 0o755
@@ -1,8 +1,9 @@
 import contextlib
 import os
-import subprocess
+import shutil
 import sys
-from typing import List
+from collections import defaultdict
+from typing import Callable, Dict, List, Set
 
 from config import WORKSPACE_DIRECTORY
 
@@ -12,20 +13,6 @@ def print_fix_details(file_path, message):
     sys.stdout.write(f"\x1b[32m> {rel_path}:\x1b[m {message}  ✅ fix applied\n")
 
 
-def sh(command: str, **kwargs):
-    return subprocess.run(
-        command, shell=True, encoding="utf-8", capture_output=True, **kwargs
-    )
-
-
-def sh_run(command, **kwargs):
-    return subprocess.run(command, shell=True, **kwargs)
-
-
-def shl(command, **kwargs):
-    return nonempty_lines(sh(command, **kwargs).stdout)
-
-
 def nonempty(lines: List[str]) -> List[str]:
     return [line for line in lines if line]
 
@@ -44,20 +31,139 @@ def writelines(filepath: str, lines: List[str]):
         return f.writelines(lines)
 
 
-# TODO: Batch rewrite lines
+def write_file_atomic(filepath: str, lines: List[str]):
+    """Writes the file via a temp file, so that it is never left half-written.
+
+    If the path is a symlink, the file it points to is replaced, rather than
+    the link itself.
+    """
+    filepath = os.path.realpath(filepath)
+    tmp_path = filepath + ".bb-fix.tmp"
+    try:
+        writelines(tmp_path, lines)
+        shutil.copymode(filepath, tmp_path)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# Returns new lines derived from the given ones, which must not be modified.
+LinesTransform = Callable[[List[str]], List[str]]
+
+
+class FileEdits:
+    """Pending edits to a single file.
+
+    Line numbers are 1-based and always refer to the file as it was before any
+    edits were applied, so that fixes for different errors in the same file
+    don't need to account for each other's edits.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.deletions: Set[int] = set()
+        self.rewrites: Dict[int, str] = {}
+        self.insertions: Dict[int, List[str]] = defaultdict(list)
+        # Applied in order to the whole file, after all line edits.
+        self.transforms: List[LinesTransform] = []
+
+    def delete(self, line_number: int):
+        self.deletions.add(line_number)
+
+    def rewrite(self, line_number: int, line: str):
+        if not line.endswith("\n"):
+            line = line + "\n"
+        self.rewrites[line_number] = line
+
+    def insert(self, line_number: int, line: str):
+        """Inserts a line before the given line number."""
+        if line not in self.insertions[line_number]:
+            self.insertions[line_number].append(line)
+
+    def transform(self, func: LinesTransform):
+        self.transforms.append(func)
+
+    def apply(self, lines: List[str]) -> List[str]:
+        if not (self.insertions or self.deletions or self.rewrites):
+            # Transforms don't modify their input, so the lines can be passed
+            # as-is, letting them reuse anything already derived from them.
+            out = lines
+        else:
+            out = []
+            for line_number, line in enumerate(lines, start=1):
+                out.extend(self.insertions.get(line_number, []))
+                if line_number in self.deletions:
+                    continue
+                out.append(self.rewrites.get(line_number, line))
+            out.extend(self.insertions.get(len(lines) + 1, []))
+        for func in self.transforms:
+            out = func(out)
+        return out
+
+
+# Source file contents, loaded at most once per run and shared by all fixes.
+_SOURCE_LINES: Dict[str, List[str]] = {}
+_PENDING_EDITS: Dict[str, FileEdits] = {}
+# Batches of edits made by other means (e.g. external tools), keyed by name.
+_PENDING_BATCHES: Dict[str, Callable[[], None]] = {}
+
+
+def source_lines(path: str) -> List[str]:
+    """Returns the lines of a source file, reading it only on first access.
+
+    The returned list is shared and must not be modified; use file_edits to
+    make changes instead. Pending edits are not reflected until apply_edits
+    is called.
+    """
+    if path not in _SOURCE_LINES:
+        _SOURCE_LINES[path] = readlines(path)
+    return _SOURCE_LINES[path]
+
+
+def reset_source_files():
+    """Discards all cached file contents and pending edits."""
+    _SOURCE_LINES.clear()
+    _PENDING_EDITS.clear()
+    _PENDING_BATCHES.clear()
+
+
+def file_edits(path: str) -> FileEdits:
+    if path not in _PENDING_EDITS:
+        _PENDING_EDITS[path] = FileEdits(path)
+    return _PENDING_EDITS[path]
+
+
+def defer_batch(name: str, apply: Callable[[], None]):
+    """Schedules a function which applies a batch of edits to run once, when
+    apply_edits is called. Scheduling the same name more than once has no
+    further effect."""
+    _PENDING_BATCHES.setdefault(name, apply)
+
+
+def apply_edits():
+    """Applies all pending edits, reading and writing each file once."""
+    for path, edits in _PENDING_EDITS.items():
+        lines = source_lines(path)
+        new_lines = edits.apply(lines)
+        if new_lines != lines:
+            write_file_atomic(path, new_lines)
+            _SOURCE_LINES[path] = new_lines
+    _PENDING_EDITS.clear()
+    for apply in _PENDING_BATCHES.values():
+        apply()
+    _PENDING_BATCHES.clear()
+
+
 def rewrite_line(filepath: str, line_number: int, line: str):
-    if not line.endswith("\n"):
-        line = line + "\n"
-    lines = readlines(filepath)
-    lines[line_number - 1] = line
-    writelines(filepath, lines)
+    file_edits(filepath).rewrite(line_number, line)
 
 
 def delete_line(path: str, line_number: int):
-    lines = readlines(path)
-    lines = lines[: line_number - 1] + lines[line_number:]
-    with open(path, "w") as f:
-        f.writelines(lines)
+    file_edits(path).delete(line_number)
 
 
 def strip_ctrl_seqs(line: str) -> str:
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+import common
+
+
+def test_file_edits_use_original_line_numbers():
+    edits = common.FileEdits("test.txt")
+    edits.delete(2)
+    edits.rewrite(4, "FOUR")
+    edits.insert(3, "2.5\n")
+    edits.insert(3, "2.5\n")
+    edits.insert(5, "end\n")
+    edits.transform(lambda lines: ["start\n"] + lines)
+
+    lines = ["1\n", "2\n", "3\n", "4\n"]
+
+    assert edits.apply(lines) == ["start\n", "1\n", "2.5\n", "3\n", "FOUR\n", "end\n"]
+
+
+def test_apply_edits_writes_each_file_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "test.txt")
+    with open(path, "w") as f:
+        f.write("1\n2\n3\n")
+    writes = []
+    writelines = common.writelines
+
+    def recording_writelines(path, lines):
+        writes.append(path)
+        writelines(path, lines)
+
+    monkeypatch.setattr(common, "writelines", recording_writelines)
+
+    common.delete_line(path, 1)
+    common.rewrite_line(path, 3, "three")
+    common.delete_line(path, 1)
+    common.apply_edits()
+
+    assert common.readlines(path) == ["2\n", "three\n"]
+    assert len(writes) == 1
+
+
+def test_source_lines_are_read_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "test.txt")
+    with open(path, "w") as f:
+        f.write("1\n2\n")
+    reads = []
+    readlines = common.readlines
+
+    def recording_readlines(path):
+        reads.append(path)
+        return readlines(path)
+
+    monkeypatch.setattr(common, "readlines", recording_readlines)
+
+    assert common.source_lines(path) == ["1\n", "2\n"]
+    common.delete_line(path, 1)
+    common.apply_edits()
+    assert common.source_lines(path) == ["2\n"]
+    assert reads == [path]
+
+
+def test_write_file_atomic_replaces_symlink_target(tmp_path):
+    target = tmp_path / "foo.go"
+    target.write_text("old\n")
+    link = tmp_path / "link.go"
+    link.symlink_to(target)
+
+    common.write_file_atomic(str(link), ["new\n"])
+
+    assert link.is_symlink()
+    assert target.read_text() == "new\n"
+
+
+def test_write_file_atomic_cleans_up_after_failed_write(tmp_path):
+    path = tmp_path / "foo.go"
+    path.write_text("old\n")
+
+    with pytest.raises(UnicodeEncodeError):
+        common.write_file_atomic(str(path), ["\udcff\n"])
+
+    assert path.read_text() == "old\n"
+    assert os.listdir(tmp_path) == ["foo.go"]
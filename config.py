@@ -1,5 +1,14 @@
 import os
-import shutil
+
+
+def _env_number(name: str, default, parse=int):
+    """Parses a numeric env var, falling back to the default if it's unset or
+    invalid, so that a bad value can't break every run."""
+    try:
+        return parse(os.getenv(name) or default)
+    except ValueError:
+        return default
+
 
 # TODO: Remove BuildBuddy repo references
 OSS_REPO_PATH = os.getenv("BUILDBUDDY_REPO_PATH")
@@ -7,4 +16,48 @@ OSS_PREFIX = "external/com_github_buildbuddy_io_buildbuddy/"
 INTERNAL_REPO_PATH = os.getenv("BUILDBUDDY_INTERNAL_REPO_PATH")
 
 WORKSPACE_DIRECTORY = os.getenv("BUILD_WORKSPACE_DIRECTORY") or os.getcwd()
+
+# JSON file declaring the workspaces that fixes may be applied to. If it
+# doesn't exist, the repos above are used. See workspace.configured_workspaces.
+WORKSPACES_CONFIG = os.getenv("BB_DEV_PLUGINS_WORKSPACES") or os.path.join(
+    os.getenv("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"),
+    "bb-dev-plugins",
+    "workspaces.json",
+)
 DEBUG = os.getenv("BB_GO_FIX_DEBUG") == "1"
+
+CACHE_DIR = os.getenv("BB_DEV_PLUGINS_CACHE_DIR") or os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "bb-dev-plugins"
+)
+
+# File that a record of each run is appended to, for `python3 metrics.py` to
+# report on. Set to an empty string to disable. See metrics.py.
+METRICS_PATH = os.getenv(
+    "BB_DEV_PLUGINS_METRICS", os.path.join(CACHE_DIR, "metrics.jsonl")
+)
+
+# Number of processes used to build the import index. 0 means one per CPU.
+INDEX_WORKERS = _env_number("BB_DEV_PLUGINS_INDEX_WORKERS", 0)
+
+# Whether parsed BUILD file targets are cached on disk between runs.
+PERSIST_BUILD_INDEX = os.getenv("BB_DEV_PLUGINS_PERSIST_BUILD_INDEX", "1") == "1"
+
+# Whether fixers may start loading indexes and source files in the background
+# as soon as errors are found, while the rest of the log is scanned.
+PIPELINE = os.getenv("BB_DEV_PLUGINS_PIPELINE", "1") == "1"
+
+# Whether to process bazel logs in a resident daemon which keeps indexes warm
+# between builds, and how long the daemon waits for a request before exiting.
+DAEMON = os.getenv("BB_DEV_PLUGINS_DAEMON") == "1"
+DAEMON_IDLE_TIMEOUT = _env_number(
+    "BB_DEV_PLUGINS_DAEMON_IDLE_TIMEOUT", 1800.0, float
+)
+
+# Path to the file passed to bazel's --build_event_json_file flag. If set, build
+# errors are read from it instead of the console log. See bep.py.
+BEP_PATH = os.getenv("BB_DEV_PLUGINS_BEP_FILE")
+
+# Paths to write a Chrome trace or cProfile dump to at the end of each run.
+# See tracing.py.
+TRACE_PATH = os.getenv("BB_DEV_PLUGINS_TRACE")
+PROFILE_PATH = os.getenv("BB_DEV_PLUGINS_PROFILE")
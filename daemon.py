@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Resident daemon which keeps indexes warm between bazel invocations.
+
+When BB_DEV_PLUGINS_DAEMON=1 is set, post_bazel.py sends the bazel log path
+to the daemon over a Unix socket instead of processing it in-process. If no
+daemon is running, one is started in the background and the current log is
+processed in-process. The daemon exits after DAEMON_IDLE_TIMEOUT seconds
+without requests.
+"""
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import traceback
+
+import metrics
+import tracing
+from common import warn
+from config import (
+    CACHE_DIR,
+    DAEMON_IDLE_TIMEOUT,
+    WORKSPACE_DIRECTORY,
+    WORKSPACES_CONFIG,
+)
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Env vars which affect the plugin's behavior. A client only talks to a daemon
+# that was started with the same values.
+DAEMON_ENV_VARS = [
+    "BUILDBUDDY_REPO_PATH",
+    "BUILDBUDDY_INTERNAL_REPO_PATH",
+    "BB_GO_FIX_DEBUG",
+    "BB_DEV_PLUGINS_BEP_FILE",
+    "BB_DEV_PLUGINS_WORKSPACES",
+    "BB_DEV_PLUGINS_PIPELINE",
+    "BB_DEV_PLUGINS_METRICS",
+]
+
+
+def socket_path() -> str:
+    key = hashlib.sha1()
+    key.update(WORKSPACE_DIRECTORY.encode("utf-8"))
+    for name in DAEMON_ENV_VARS:
+        key.update(b"\0" + os.getenv(name, "").encode("utf-8"))
+    # Restart the daemon whenever the workspaces or the plugin itself are
+    # updated.
+    with contextlib.suppress(OSError):
+        key.update(b"\0%d" % os.stat(WORKSPACES_CONFIG).st_mtime_ns)
+    for path in sorted(glob.glob(os.path.join(PLUGIN_DIR, "*.py"))):
+        key.update(b"\0%d" % os.stat(path).st_mtime_ns)
+    return os.path.join(CACHE_DIR, "daemon", key.hexdigest()[:16] + ".sock")
+
+
+def start_daemon():
+    subprocess.Popen(
+        [sys.executable, os.path.join(PLUGIN_DIR, "daemon.py")],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def run_in_daemon(bazel_logs_path: str) -> bool:
+    """Asks the daemon to process the bazel log, relaying its output.
+
+    Returns False if the daemon isn't running, in which case it is started
+    for the next build and the caller should process the log itself.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path())
+    except OSError:
+        sock.close()
+        start_daemon()
+        return False
+
+    with sock, sock.makefile("rwb") as conn:
+        request = {"cwd": os.getcwd(), "bazel_logs_path": bazel_logs_path}
+        conn.write(json.dumps(request).encode("utf-8") + b"\n")
+        conn.flush()
+        for line in conn:
+            message = json.loads(line)
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+            elif "exit" in message:
+                return True
+    # The request was already sent, so fixes may have been partially applied;
+    # don't risk applying them twice by falling back to in-process mode.
+    warn("bb-dev-plugins daemon exited unexpectedly")
+    return True
+
+
+class _StreamWriter:
+    """File-like object which forwards writes to the client."""
+
+    def __init__(self, conn, stream: str):
+        self.conn = conn
+        self.stream = stream
+
+    def write(self, data: str) -> int:
+        message = json.dumps({self.stream: data}).encode("utf-8")
+        self.conn.write(message + b"\n")
+        return len(data)
+
+    def flush(self):
+        self.conn.flush()
+
+
+def reset_run_state():
+    """Discards per-run caches, so that changes made between builds are seen.
+
+    Indexes which can be validated cheaply (the Go and TS import indexes and
+    persisted BUILD targets) are kept in memory.
+    """
+    import common
+    import go
+    import negative_cache
+    import ts
+    import workspace
+
+    common.reset_source_files()
+    negative_cache.reset_negative_cache()
+    workspace.reset_BUILD_targets()
+    go.reset_package_resolutions()
+    go.reset_gazelle_dirs()
+    go.reset_go_headers()
+    go.reset_prefetched_paths()
+    ts.reset_ts_symbols()
+    ts.reset_dep_edits()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        import post_bazel
+
+        request = json.loads(self.rfile.readline())
+        stdout = _StreamWriter(self.wfile, "stdout")
+        stderr = _StreamWriter(self.wfile, "stderr")
+        exit_code = 0
+        cwd = os.getcwd()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                os.chdir(request["cwd"])
+                reset_run_state()
+                with tracing.profile(), metrics.phase("post_bazel"):
+                    post_bazel.run(request["bazel_logs_path"])
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os.chdir(cwd)
+                tracing.write_trace()
+                metrics.write_record()
+        self.wfile.write(json.dumps({"exit": exit_code}).encode("utf-8") + b"\n")
+
+
+class _DaemonServer(socketserver.UnixStreamServer):
+    idle = False
+
+    def handle_timeout(self):
+        self.idle = True
+
+
+def serve():
+    # Anyone who can connect to the socket can have the daemon edit the
+    # owner's files, so the socket, and everything else the daemon writes, is
+    # only accessible to the owner.
+    os.umask(0o077)
+    path = socket_path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    os.chmod(os.path.dirname(path), 0o700)
+
+    # Only one daemon may serve a given socket. If another one is starting up
+    # or already running, let it be.
+    lock_file = open(path + ".lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return
+
+    import go
+    import ts
+
+    # Warm the import indexes before accepting requests; until then, clients
+    # fall back to processing logs in-process.
+    go.package_resolutions()
+    ts.ts_symbols()
+
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    server = _DaemonServer(path, _RequestHandler)
+    server.timeout = DAEMON_IDLE_TIMEOUT
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while not server.idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        lock_file.close()
+
+
+if __name__ == "__main__":
+    serve()
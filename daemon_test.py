@@ -0,0 +1,60 @@
+import os
+import stat
+import subprocess
+import sys
+import time
+
+import daemon
+
+CLIENT_SCRIPT = "import sys, daemon; print(daemon.run_in_daemon(sys.argv[1]))"
+
+
+def _run_python(script, *args, env):
+    return subprocess.run(
+        [sys.executable, "-c", script, *args],
+        cwd=os.path.dirname(os.path.abspath(daemon.__file__)),
+        env=env,
+        capture_output=True,
+        encoding="utf-8",
+        check=True,
+    ).stdout.strip()
+
+
+def test_daemon_processes_logs_privately(tmp_path):
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    log_path = tmp_path / "bazel.log"
+    log_path.write_text("INFO: Build completed successfully, 1 total action\n")
+    metrics_path = tmp_path / "cache" / "metrics.jsonl"
+    env = {
+        **os.environ,
+        "BUILD_WORKSPACE_DIRECTORY": str(workspace),
+        "BB_DEV_PLUGINS_CACHE_DIR": str(tmp_path / "cache"),
+        "BB_DEV_PLUGINS_METRICS": str(metrics_path),
+        "BB_DEV_PLUGINS_WORKSPACES": str(tmp_path / "workspaces.json"),
+        "BB_DEV_PLUGINS_DAEMON_IDLE_TIMEOUT": "30",
+    }
+    for name in ("BUILDBUDDY_REPO_PATH", "BUILDBUDDY_INTERNAL_REPO_PATH"):
+        env.pop(name, None)
+    plugin_dir = os.path.dirname(os.path.abspath(daemon.__file__))
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(plugin_dir, "daemon.py")],
+        cwd=str(workspace),
+        env=env,
+    )
+    try:
+        socket_path = _run_python(
+            "import daemon; print(daemon.socket_path())", env=env
+        )
+        deadline = time.monotonic() + 30
+        while not os.path.exists(socket_path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        served = _run_python(CLIENT_SCRIPT, str(log_path), env=env)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    assert served == "True"
+    socket_dir_mode = os.stat(os.path.dirname(socket_path)).st_mode
+    assert stat.S_IMODE(socket_dir_mode) == 0o700
+    assert stat.S_IMODE(os.stat(metrics_path).st_mode) & 0o077 == 0
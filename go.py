@@ -1,22 +1,39 @@
 import os
 import re
+import sys
 from collections import Counter, defaultdict
 from dataclasses import dataclass
-from typing import List, Tuple, Union
+from sys import intern
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, Union
 
+import background
+import tools
+import tracing
 from common import (
+    defer_batch,
     delete_line,
+    file_edits,
     print_fix_details,
     readlines,
     rewrite_line,
-    sh_run,
-    shl,
+    source_lines,
     strip_ctrl_seqs,
     warn,
     workdir,
 )
-from config import INTERNAL_REPO_PATH, OSS_REPO_PATH
-from workspace import get_source_file_info
+from negative_cache import entry_key, file_digest, is_unfixable, mark_unfixable
+from repo_files import is_BUILD_path, is_go_path, list_repo_files
+from repo_index import (
+    FileChunk,
+    IndexRef,
+    RepoIndex,
+    chunked,
+    has_repo_index,
+    load_repo_index,
+    map_chunks,
+    repo_index_digest,
+)
+from workspace import configured_workspaces, get_source_file_info
 
 LINE_PATTERN = r"/[^/]*?\.go:\d+:\d+:.*"
 MISSING_IMPORT_PATTERN = r'^\s*(.*?\.go): import of "(.*)"'
@@ -26,9 +43,92 @@ LineRange = Tuple[int, int]
 
 BLOCK_DELIMITERS = ["()", r"{}", "[]"]
 
+# Tokens which can appear in a Go file header. Whitespace (including newlines)
+# before each token is skipped; `/*` only matches the start of a block comment,
+# since its end may be on a later line.
+GO_TOKEN_PATTERN = re.compile(
+    r"""\s*(?:
+    (?P<comment>//.*|/\*)
+    |(?P<string>"(?:[^"\\\n]|\\.)*"|`[^`]*`)
+    |(?P<ident>[A-Za-z_]\w*)
+    |(?P<punct>\S)
+    )""",
+    re.VERBOSE,
+)
+
+# Matches most lines in an import group, which are parsed without being
+# tokenized.
+SIMPLE_IMPORT_SPEC_PATTERN = re.compile(
+    r'\s*(?:([A-Za-z_]\w*|\.)\s+)?"([^"\\\n]*)"\s*$'
+)
+
 
-# TODO: build import index only if needed
 _PACKAGE_RESOLUTIONS = None
+# Digest of the index that package resolutions were (or will be) loaded from.
+_IMPORT_INDEX_DIGEST: Union[str, None] = None
+
+# Includes bazel startup and analysis, if the server isn't running.
+GAZELLE_TIMEOUT_S = 600
+
+# Workspace-relative dirs to run Gazelle on, by workspace path.
+_PENDING_GAZELLE_DIRS: Dict[str, Dict[str, None]] = {}
+
+
+def source_path(file_path: str) -> str:
+    source = get_source_file_info(file_path)
+    return source["realpath"] if source else file_path
+
+
+# Substrings identifying the kinds of errors handled by try_fix_error, for
+# metrics.
+ERROR_KINDS = [
+    ("imported and not used", "unused_import"),
+    ("undefined:", "undefined"),
+    ("unexpected { in type declaration", "type_declaration"),
+    ("non-declaration statement outside function body", "non_declaration"),
+]
+
+
+def error_kind(line) -> str:
+    for substring, kind in ERROR_KINDS:
+        if substring in line:
+            return kind
+    return "other"
+
+
+def error_key(line) -> Union[Tuple, None]:
+    """Returns a key identifying the error on the given line, so that the same
+    error reported for several configurations or targets is fixed once."""
+    line = strip_ctrl_seqs(line)
+    m = re.search(r"(.*?\.go):(\d+)(?::\d+)?:\s*(.*)", line)
+    if not m:
+        return None
+    return (source_path(m.group(1)), int(m.group(2)), m.group(3).strip())
+
+
+def import_key(file_path, import_url) -> Tuple:
+    return (source_path(file_path), import_url)
+
+
+def refers_to_other_package(lines: Lines, line_number: int, symbol: str) -> bool:
+    """Returns whether an undefined symbol may refer to a package which isn't
+    imported."""
+    # Never try to resolve symbols that refer to the current package.
+    if symbol == get_package_name(lines):
+        return False
+    # If the symbol is not followed by `.` in the source line referenced by the error,
+    # then the symbol is not referring to a package, so do nothing.
+    source_line = lines[line_number - 1]
+    return (symbol + ".") in source_line
+
+
+def undefined_symbol_key(path, line_number, symbol) -> Union[str, None]:
+    index_digest = import_index_digest()
+    if index_digest is None:
+        return None
+    return entry_key(
+        "go.undefined", file_digest(path), line_number, symbol, index_digest
+    )
 
 
 def try_fix_error(line) -> bool:
@@ -54,14 +154,13 @@ def try_fix_error(line) -> bool:
     m = re.search(r"undefined:\s+([A-Za-z_]+)$", line)
     if m:
         undef_symbol = m.group(1)
-        source_lines = readlines(source["realpath"])
-        # Never try to resolve symbols that refer to the current package.
-        if undef_symbol == get_package_name(source_lines):
+        lines = source_lines(source["realpath"])
+        if not refers_to_other_package(lines, line_number, undef_symbol):
             return False
-        # If the symbol is not followed by `.` in the source line referenced by the error,
-        # then the symbol is not referring to a package, so do nothing.
-        source_line = source_lines[line_number - 1]
-        if (undef_symbol + ".") not in source_line:
+
+        # Skip symbols which couldn't be resolved by a previous run.
+        unfixable_key = undefined_symbol_key(source_path, line_number, undef_symbol)
+        if unfixable_key and is_unfixable(unfixable_key):
             return False
 
         for symbol, import_url in package_resolutions().items():
@@ -71,8 +170,14 @@ def try_fix_error(line) -> bool:
                     alias = symbol
                 return add_import(source["realpath"], import_url, alias=alias)
 
+        # Loading the resolutions may have updated the index, so the key needs
+        # to be recomputed.
+        unfixable_key = undefined_symbol_key(source_path, line_number, undef_symbol)
+        if unfixable_key:
+            mark_unfixable(unfixable_key)
+
     if "unexpected { in type declaration" in line:
-        lines = readlines(source["realpath"])
+        lines = source_lines(source["realpath"])
         if match := re.search(r"type\s+([^\s]+)\s*{$", lines[line_number - 1]):
             struct_name = match.group(1)
             rewrite_line(
@@ -85,7 +190,7 @@ def try_fix_error(line) -> bool:
             return True
 
     if "non-declaration statement outside function body" in line:
-        lines = readlines(source["realpath"])
+        lines = source_lines(source["realpath"])
         interface_match = re.search(
             r"^(interface|struct)\s+([^\s]+)\s*\{$", lines[line_number - 1]
         )
@@ -107,46 +212,165 @@ def try_fix_import(file_path, import_url) -> bool:
         warn(f"Could not determine source info for {file_path}")
         return False
 
+    # Gazelle is slow to start, so rather than running it for each error,
+    # collect the directories to update and run it once per workspace.
     parent_dir_path = os.path.dirname(source["workspace_relative_path"])
-    sh_run(
-        f'cd {source["workspace_path"]} && bazel run //:gazelle -- {parent_dir_path}'
-    )
-    print_fix_details(file_path, "gazelle")
+    defer_batch("gazelle", run_gazelle)
+    dirs = _PENDING_GAZELLE_DIRS.setdefault(source["workspace_path"], {})
+    if parent_dir_path not in dirs:
+        dirs[parent_dir_path] = None
+        print_fix_details(file_path, "gazelle")
+    return True
+
+
+def collapse_dirs(dirs: List[str]) -> List[str]:
+    """Returns the given workspace-relative dirs, sorted and without
+    duplicates or any dirs nested under another one (which Gazelle visits
+    anyway, since it updates dirs recursively)."""
+    out: List[str] = []
+    for path in sorted(set(dirs)):
+        if out and (out[-1] == "" or path.startswith(out[-1] + "/")):
+            continue
+        out.append(path)
+    return out
+
+
+def reset_gazelle_dirs():
+    _PENDING_GAZELLE_DIRS.clear()
+
+
+@tracing.traced("run_gazelle")
+def run_gazelle():
+    """Runs Gazelle on all directories with missing imports, once per
+    workspace."""
+    commands = [
+        tools.Command(
+            ["bazel", "run", "//:gazelle", "--"]
+            + [path or "." for path in collapse_dirs(list(dirs))],
+            cwd=workspace_path,
+            timeout=GAZELLE_TIMEOUT_S,
+            merge_stderr=True,
+        )
+        for workspace_path, dirs in _PENDING_GAZELLE_DIRS.items()
+    ]
+    _PENDING_GAZELLE_DIRS.clear()
+    # Each workspace has its own bazel server, so they can run concurrently.
+    # Their output is captured and printed per workspace so that it doesn't
+    # interleave.
+    for result in tools.run_all(commands):
+        if result.stdout:
+            sys.stderr.write(f"gazelle output in {result.command.cwd}:\n")
+            sys.stderr.write(result.text())
+        if not result.ok:
+            warn(f"gazelle failed in {result.command.cwd}")
+
+
+def reset_package_resolutions():
+    """Forces package resolutions to be reloaded on next use, picking up any
+    repo changes since they were last loaded."""
+    global _PACKAGE_RESOLUTIONS, _IMPORT_INDEX_DIGEST
+    _PACKAGE_RESOLUTIONS = None
+    _IMPORT_INDEX_DIGEST = None
 
 
 def package_resolutions():
     global _PACKAGE_RESOLUTIONS
     if _PACKAGE_RESOLUTIONS is None:
-        _PACKAGE_RESOLUTIONS = build_import_index()
+        _PACKAGE_RESOLUTIONS = load_import_index()
     return _PACKAGE_RESOLUTIONS
 
 
+def prefetch_error(line):
+    """Starts loading what's needed to fix the error in the background: the
+    source file, and the import index if the error might be fixed by adding an
+    import."""
+    line = strip_ctrl_seqs(line)
+    m = re.search(r"(.*?\.go):(\d+)", line)
+    if not m:
+        return
+    file_path = m.group(1)
+    if file_path not in _PREFETCHED_PATHS:
+        _PREFETCHED_PATHS.add(file_path)
+        background.submit(_prefetch_source, file_path)
+    undefined = re.search(r"undefined:\s+([A-Za-z_]+)$", line)
+    if undefined and _PACKAGE_RESOLUTIONS is None:
+        background.submit(
+            _prefetch_package_resolutions,
+            file_path,
+            int(m.group(2)),
+            undefined.group(1),
+        )
+
+
+# Paths named in errors which were already submitted for prefetching.
+_PREFETCHED_PATHS: Set[str] = set()
+
+
+def _prefetch_source(file_path):
+    source = get_source_file_info(file_path)
+    if source is not None:
+        source_lines(source["realpath"])
+
+
+def _prefetch_package_resolutions(file_path, line_number, symbol):
+    # Background work runs in order, so this runs after the source file is
+    # read, and only loads the index if try_fix_error would.
+    if _PACKAGE_RESOLUTIONS is not None:
+        return
+    source = get_source_file_info(file_path)
+    if source is None:
+        return
+    source_path = source["realpath"]
+    if not refers_to_other_package(source_lines(source_path), line_number, symbol):
+        return
+    unfixable_key = undefined_symbol_key(source_path, line_number, symbol)
+    if unfixable_key and is_unfixable(unfixable_key, record_hit=False):
+        return
+    package_resolutions()
+
+
+def reset_prefetched_paths():
+    _PREFETCHED_PATHS.clear()
+
+
 def add_import(file_path, url, alias=None) -> bool:
-    with open(file_path, "r") as f:
-        lines = f.readlines()
+    lines = source_lines(file_path)
+    if get_imports(lines) is None and get_package_line_index(lines) is None:
+        return False
+    file_edits(file_path).transform(lambda lines: insert_import(lines, url, alias))
+    print_fix_details(file_path, f'add import "{url}"')
+    return True
+
+
+def insert_import(lines: List[str], url, alias=None) -> List[str]:
+    # The header is parsed (and cached) for the given lines, so the edits are
+    # made to a copy. See go_header_of.
     go_imports = get_imports(lines)
+    package_line_index = get_package_line_index(lines)
+    lines = list(lines)
     if go_imports is None:
-        package_line_index = get_package_line_index(lines)
         if package_line_index is None:
-            return False
+            return lines
         imports = [GoImport(url, alias, None)]
         lines[package_line_index + 1 : package_line_index + 1] = [
             "\n"
         ] + render_sorted_imports(imports)
     else:
         imports = go_imports.imports
+        if any(imp.url == url and imp.alias == alias for imp in imports):
+            return lines
         imports.append(GoImport(url, alias, None))
         start, end = go_imports.line_range
         lines[start:end] = render_sorted_imports(imports)
-
-    with open(file_path, "w") as f:
-        f.writelines(lines)
-    print_fix_details(file_path, f'add import "{url}"')
-    return True
+    return lines
 
 
 @dataclass
 class GoImport:
+    # The indexer creates one of these per import in the repo, so they are
+    # kept compact.
+    __slots__ = ("url", "alias", "trailing_comment")
+
     url: str
     alias: Union[str, None]
     trailing_comment: Union[str, None]
@@ -172,32 +396,29 @@ class ImportSection:
 
 
 def get_package_line_index(lines: List[str]) -> Union[int, None]:
-    for (i, line) in enumerate(lines):
-        if line.startswith("package "):
-            return i
-    return None
+    return go_header_of(lines).package_line
 
 
 def get_imports(lines: List[str]) -> Union[ImportSection, None]:
-    import_block = find_block(lines, r"^import\s+\(")
-    if import_block is None:
+    """Returns the import declaration that new imports should be added to: the
+    first grouped declaration, or else the first single-line one.
+
+    `import "C"` is never returned, since cgo requires it to be declared on
+    its own.
+    """
+    decls = [
+        decl
+        for decl in go_header_of(lines).import_decls
+        if not any(imp.url == "C" for imp in decl.imports)
+    ]
+    if not decls:
         return None
-
-    imports = []
-    start, end = import_block
-    for line in lines[start + 1 : end - 1]:
-        go_import = parse_import(line)
-        if go_import:
-            imports.append(go_import)
-    return ImportSection(line_range=(start, end), imports=imports)
+    decl = next((decl for decl in decls if decl.grouped), decls[0])
+    return ImportSection(line_range=decl.line_range, imports=list(decl.imports))
 
 
 def get_package_name(lines: List[str]) -> Union[str, None]:
-    if not lines:
-        return None
-    if m := re.match(r"^package\s+([A-Za-z0-9_]+)$", lines[0]):
-        return m.group(1)
-    return None
+    return go_header_of(lines).package_name
 
 
 def render_sorted_imports(imports: List[GoImport]) -> List[str]:
@@ -239,29 +460,6 @@ def render_sorted_imports(imports: List[GoImport]) -> List[str]:
     )
 
 
-def parse_import(line: str) -> Union[GoImport, None]:
-    line = line.strip()
-    line = re.sub(r"\s+", " ", line)
-    if not line or line.startswith("//"):
-        return None
-    tokens = line.split()
-    alias_token = None
-    trailing_comment = None
-    if len(tokens) == 1:
-        url_token = tokens[0]
-    else:
-        alias_token = tokens[0]
-        url_token = tokens[1]
-        if len(tokens) > 2 and tokens[2].startswith("//"):
-            comment_parts = line.split("//")
-            trailing_comment = "//".join(comment_parts[1:])
-    if not (url_token[0] == '"' and url_token[-1] == '"'):
-        return None
-    return GoImport(
-        url=url_token[1:-1], alias=alias_token, trailing_comment=trailing_comment
-    )
-
-
 def find_block(lines: Lines, start_pattern: str) -> Union[LineRange, None]:
     delims = None
     for (delim_start, delim_end) in BLOCK_DELIMITERS:
@@ -292,53 +490,369 @@ def line_matches(pattern, lines: Lines):
     return out
 
 
-PATHS_TO_INDEX = [OSS_REPO_PATH, INTERNAL_REPO_PATH]
+# Each workspace has its own persistent index, which are merged when loaded.
+PATHS_TO_INDEX = [ws.path for ws in configured_workspaces()]
+
+# Bump this whenever the format of the on-disk import index changes.
+IMPORT_INDEX_VERSION = 3
+
+# (ref_token, url) pair contributed to the import index by a single import.
+ImportRef = IndexRef
 
-LIST_FILES_COMMAND = "bash --norc -c 'comm -23 <(git ls-files --exclude-standard --cached --others | sort) <(git ls-files --deleted | sort)'"
 
+@dataclass
+class ImportDecl:
+    line_range: LineRange
+    imports: List[GoImport]
+    # Whether this is a parenthesized declaration, like `import ( ... )`.
+    grouped: bool
 
-def find_all_imports_by_go_reference():
-    all_imports: List[GoImport] = []
-    for path in shl(LIST_FILES_COMMAND + r" | grep -E '\.go$'"):
-        lines = readlines(path)
-        if go_imports := get_imports(lines):
-            all_imports.extend(go_imports.imports)
-    return all_imports
 
+@dataclass
+class GoHeader:
+    """The package clause and import declarations at the top of a Go file.
 
-def find_all_imports_by_BUILD_declaration():
-    all_imports: List[GoImport] = []
-    for path in shl(LIST_FILES_COMMAND + r" | grep BUILD"):
-        if not (path == "BUILD" or path.endswith("/BUILD")):
-            continue
-        lines = readlines(path)
-        for m in line_matches(r'importpath[\s]*?=[\s]*?"(.*?)"', lines):
-            all_imports.append(
-                GoImport(url=m.group(1), alias=None, trailing_comment=None)
+    Line numbers are 0-based indexes into the file's lines.
+    """
+
+    package_name: Union[str, None]
+    package_line: Union[int, None]
+    import_decls: List[ImportDecl]
+    # Line ranges of comments in the header.
+    comments: List[LineRange]
+    # Index of the line containing the first declaration after the imports, or
+    # the number of lines if there is none.
+    end: int
+
+    @property
+    def imports(self) -> List[GoImport]:
+        return [imp for decl in self.import_decls for imp in decl.imports]
+
+
+class _GoHeaderParser:
+    """Tokenizes a Go file line by line, up to the end of its header."""
+
+    def __init__(self):
+        self.header = GoHeader(
+            package_name=None, package_line=None, import_decls=[], comments=[], end=0
+        )
+        self.state = "top"
+        self.in_comment = False
+        self.decl_start = 0
+        self.decl_imports: List[GoImport] = []
+        self.alias: Union[str, None] = None
+        self.last_import_line = -1
+
+    def feed(self, i: int, line: str) -> bool:
+        """Parses the given line, returning False once the header has ended."""
+        if self.state == "group" and not self.in_comment:
+            m = SIMPLE_IMPORT_SPEC_PATTERN.match(line)
+            if m:
+                alias = m.group(1)
+                self.decl_imports.append(
+                    GoImport(intern(m.group(2)), alias and intern(alias), None)
+                )
+                return True
+        pos = 0
+        if self.in_comment:
+            pos = line.find("*/")
+            if pos < 0:
+                return True
+            self.in_comment = False
+            start, _ = self.header.comments[-1]
+            self.header.comments[-1] = (start, i + 1)
+            pos += 2
+        while pos >= 0:
+            pos = self._feed_tokens(i, line, pos)
+            if pos is None:
+                return False
+        return True
+
+    def _feed_tokens(self, i: int, line: str, pos: int) -> Union[int, None]:
+        """Parses tokens starting at pos. Returns where to resume after a block
+        comment, -1 once the line is done, or None once the header ended."""
+        for m in GO_TOKEN_PATTERN.finditer(line, pos):
+            kind = m.lastgroup
+            token = m.group(kind)
+            if kind == "comment":
+                self.header.comments.append((i, i + 1))
+                if token == "/*":
+                    end = line.find("*/", m.end())
+                    if end < 0:
+                        self.in_comment = True
+                        return -1
+                    return end + 2
+                if self.last_import_line == i:
+                    self.decl_imports[-1].trailing_comment = token[2:].rstrip()
+                return -1
+            if not self._token(i, kind, token):
+                self.header.end = i
+                return None
+        return -1
+
+    def _token(self, i: int, kind: str, token: str) -> bool:
+        if self.state == "top":
+            if token == "package":
+                self.state = "package"
+                self.header.package_line = i
+            elif token == "import":
+                self.state = "import"
+                self.decl_start = i
+                self.decl_imports = []
+            elif token != ";":
+                return False
+        elif self.state == "package":
+            self.header.package_name = token if kind == "ident" else None
+            self.state = "top"
+        elif self.state == "import" and token == "(":
+            self.state = "group"
+        elif self.state == "group" and token == ")":
+            self._end_decl(i, grouped=True)
+        elif kind == "string":
+            self.decl_imports.append(
+                GoImport(
+                    url=intern(token[1:-1]),
+                    alias=self.alias and intern(self.alias),
+                    trailing_comment=None,
+                )
             )
-    return all_imports
+            self.last_import_line = i
+            self.alias = None
+            if self.state == "import":
+                self._end_decl(i, grouped=False)
+        elif kind == "ident" or token == ".":
+            self.alias = token
+        return True
 
+    def _end_decl(self, i: int, grouped: bool):
+        self.header.import_decls.append(
+            ImportDecl(
+                line_range=(self.decl_start, i + 1),
+                imports=self.decl_imports,
+                grouped=grouped,
+            )
+        )
+        self.state = "top"
 
-def most_common_import_urls_by_ref_token(all_imports: List[GoImport]):
-    url_count_by_ref_token = defaultdict(Counter)
-    for go_import in all_imports:
+
+def parse_go_header(lines: Iterable[str]) -> GoHeader:
+    """Parses the header of a Go file in a single pass, consuming lines only up
+    to the first declaration after the imports."""
+    parser = _GoHeaderParser()
+    i = -1
+    for i, line in enumerate(lines):
+        if not parser.feed(i, line):
+            return parser.header
+    parser.header.end = i + 1
+    return parser.header
+
+
+# id(lines) -> (lines, header). The lines are kept so that the id can't be
+# reused while the entry exists.
+_GO_HEADERS: Dict[int, Tuple[Lines, GoHeader]] = {}
+
+
+def go_header_of(lines: Lines) -> GoHeader:
+    """Like parse_go_header, but parses each list of lines at most once.
+
+    The lines must not be modified after this is called.
+    """
+    cached = _GO_HEADERS.get(id(lines))
+    if cached is not None and cached[0] is lines:
+        return cached[1]
+    header = parse_go_header(lines)
+    _GO_HEADERS[id(lines)] = (lines, header)
+    return header
+
+
+def reset_go_headers():
+    _GO_HEADERS.clear()
+
+
+def go_file_imports(path: str) -> List[GoImport]:
+    """Returns the imports of a Go file.
+
+    Imports can only appear before any other top-level declarations, so the
+    rest of the file (which may be megabytes of generated code) isn't read.
+    """
+    with open(path, "r") as f:
+        return parse_go_header(f).imports
+
+
+def BUILD_file_imports(path: str) -> List[GoImport]:
+    lines = readlines(path)
+    return [
+        GoImport(url=intern(m.group(1)), alias=None, trailing_comment=None)
+        for m in line_matches(r'importpath[\s]*?=[\s]*?"(.*?)"', lines)
+    ]
+
+
+def find_all_imports_by_go_reference(
+    paths: Union[List[str], None] = None
+) -> Iterator[GoImport]:
+    """Yields the imports in each Go file, reading files as they're consumed."""
+    if paths is None:
+        paths = list_repo_files(os.getcwd()).go_paths
+    tracing.count("files_scanned", len(paths))
+    for path in paths:
+        yield from go_file_imports(path)
+
+
+def find_all_imports_by_BUILD_declaration(
+    paths: Union[List[str], None] = None
+) -> Iterator[GoImport]:
+    if paths is None:
+        paths = list_repo_files(os.getcwd()).BUILD_paths
+    tracing.count("files_scanned", len(paths))
+    for path in paths:
+        yield from BUILD_file_imports(path)
+
+
+def most_common_urls(url_count_by_ref_token: Dict[str, Counter]) -> Dict[str, str]:
+    urls_by_ref_token = {}
+    for ref_token, url_count in url_count_by_ref_token.items():
+        if url_count:
+            urls_by_ref_token[ref_token] = url_count.most_common()[0][0]
+    return urls_by_ref_token
+
+
+def count_import_urls(
+    imports: Iterable[GoImport], url_count_by_ref_token: Dict[str, Counter]
+):
+    """Adds the imports to the counts as they're consumed, so that they never
+    need to be held in memory all at once."""
+    for go_import in imports:
         ref_token = go_import.ref_token()
         if not ref_token:
             # Imported as "_"; ignore.
             continue
         url_count_by_ref_token[ref_token][go_import.url] += 1
 
-    urls_by_ref_token = {}
-    for ref_token, url_count in url_count_by_ref_token.items():
-        urls_by_ref_token[ref_token] = url_count.most_common()[0][0]
 
-    return urls_by_ref_token
+def most_common_import_urls_by_ref_token(all_imports: Iterable[GoImport]):
+    url_count_by_ref_token = defaultdict(Counter)
+    count_import_urls(all_imports, url_count_by_ref_token)
+    return most_common_urls(url_count_by_ref_token)
 
 
+@tracing.traced("build_import_index")
 def build_import_index():
-    all_imports: List[GoImport] = []
-    for path in PATHS_TO_INDEX:
+    url_count_by_ref_token = defaultdict(Counter)
+    repo_files = tools.map_concurrently(list_repo_files, PATHS_TO_INDEX)
+    for path, files in zip(PATHS_TO_INDEX, repo_files):
         with workdir(path):
-            all_imports.extend(find_all_imports_by_go_reference())
-            all_imports.extend(find_all_imports_by_BUILD_declaration())
-    return most_common_import_urls_by_ref_token(all_imports)
+            count_import_urls(
+                find_all_imports_by_go_reference(files.go_paths),
+                url_count_by_ref_token,
+            )
+            count_import_urls(
+                find_all_imports_by_BUILD_declaration(files.BUILD_paths),
+                url_count_by_ref_token,
+            )
+    return most_common_urls(url_count_by_ref_token)
+
+
+def import_refs_in_file(path: str) -> List[ImportRef]:
+    if is_go_path(path):
+        imports = go_file_imports(path)
+    elif is_BUILD_path(path):
+        imports = BUILD_file_imports(path)
+    else:
+        return []
+    refs = []
+    for go_import in imports:
+        ref_token = go_import.ref_token()
+        if ref_token:
+            refs.append((ref_token, go_import.url))
+    return refs
+
+
+def _count_import_refs(chunk: FileChunk) -> Dict[str, Counter]:
+    repo_path, paths = chunk
+    url_count_by_ref_token = defaultdict(Counter)
+    for path in paths:
+        for ref_token, url in import_refs_in_file(os.path.join(repo_path, path)):
+            url_count_by_ref_token[ref_token][url] += 1
+    return dict(url_count_by_ref_token)
+
+
+@tracing.traced("build_import_index_parallel")
+def build_import_index_parallel(workers: Union[int, None] = None):
+    """Like build_import_index, but scans files using a pool of worker processes.
+
+    The files are split into contiguous chunks which are merged back in their
+    original order, so that ties between equally common URLs are broken the
+    same way as in the serial version.
+    """
+    chunks: List[FileChunk] = []
+    repo_files = tools.map_concurrently(list_repo_files, PATHS_TO_INDEX)
+    for path, files in zip(PATHS_TO_INDEX, repo_files):
+        chunks.extend(chunked(path, files.go_paths))
+        chunks.extend(chunked(path, files.BUILD_paths))
+        tracing.count("files_scanned", len(files.go_paths) + len(files.BUILD_paths))
+
+    url_count_by_ref_token = defaultdict(Counter)
+    for partial_counts in map_chunks(_count_import_refs, chunks, workers):
+        for ref_token, url_count in partial_counts.items():
+            url_count_by_ref_token[ref_token].update(url_count)
+    return most_common_urls(url_count_by_ref_token)
+
+
+def list_import_index_paths(repo_path: str) -> List[str]:
+    files = list_repo_files(repo_path)
+    return files.go_paths + files.BUILD_paths
+
+
+def load_repo_import_index(
+    repo_path: str, paths: Union[List[str], None] = None
+) -> RepoIndex:
+    """Loads the import index of a single repo. `paths` may list the repo's
+    files in advance, in case the index needs to be built."""
+
+    def list_paths(path: str) -> List[str]:
+        return list_import_index_paths(path) if paths is None else paths
+
+    return load_repo_index(
+        "go_import_index",
+        IMPORT_INDEX_VERSION,
+        repo_path,
+        list_paths,
+        import_refs_in_file,
+    )
+
+
+def import_index_digest() -> Union[str, None]:
+    """Returns a digest of the current import index, or None if it isn't known
+    without loading the index."""
+    global _IMPORT_INDEX_DIGEST
+    if _IMPORT_INDEX_DIGEST is None:
+        digests = [
+            repo_index_digest("go_import_index", IMPORT_INDEX_VERSION, path)
+            for path in PATHS_TO_INDEX
+        ]
+        if None not in digests:
+            _IMPORT_INDEX_DIGEST = ":".join(digests)
+    return _IMPORT_INDEX_DIGEST
+
+
+@tracing.traced("load_import_index")
+def load_import_index():
+    """Like build_import_index, but uses the persistent per-repo indexes."""
+    global _IMPORT_INDEX_DIGEST
+    # Repos without an index need to be listed in full to build one, which
+    # mostly waits on git, so list them all at once.
+    unindexed = [
+        path for path in PATHS_TO_INDEX if not has_repo_index("go_import_index", path)
+    ]
+    paths_by_repo = dict(
+        zip(unindexed, tools.map_concurrently(list_import_index_paths, unindexed))
+    )
+    url_count_by_ref_token = defaultdict(Counter)
+    digests = []
+    for path in PATHS_TO_INDEX:
+        index = load_repo_import_index(path, paths_by_repo.pop(path, None))
+        digests.append(index.digest)
+        for ref_token, url_count in index.value_count_by_key.items():
+            url_count_by_ref_token[ref_token].update(url_count)
+    _IMPORT_INDEX_DIGEST = ":".join(digests) if all(digests) else None
+    return most_common_urls(url_count_by_ref_token)
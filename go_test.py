@@ -1,6 +1,16 @@
+import contextlib
 import io
+import os
+import subprocess
+import threading
 
+import background
+import cache
+import common
 import go
+import negative_cache
+import repo_index
+import tools
 
 MULTILINE_IMPORT = """package test
 
@@ -55,3 +65,505 @@ def test_render_go_imports():
     rendered = go.render_sorted_imports(import_section.imports)
 
     assert "".join(rendered) == CORRECT_IMPORTS
+
+
+def _git(repo, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@test", *args],
+        cwd=repo,
+        check=True,
+        capture_output=True,
+    )
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_load_import_index_is_incremental(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    repo = str(tmp_path / "repo")
+    _write(f"{repo}/a.go", 'package a\n\nimport (\n\tfoopb "example.com/foo"\n)\n')
+    _write(f"{repo}/b/BUILD", 'go_library(importpath = "example.com/b")\n')
+    _git(repo, "init", "-q")
+    _git(repo, "add", "-A")
+    _git(repo, "commit", "-q", "-m", "init")
+    monkeypatch.setattr(go, "PATHS_TO_INDEX", [repo])
+
+    assert go.load_import_index() == go.build_import_index()
+
+    # Commit one change, leave another uncommitted, and add an untracked file.
+    _write(f"{repo}/a.go", 'package a\n\nimport (\n\tfoopb "example.com/foo2"\n)\n')
+    _git(repo, "commit", "-q", "-am", "update")
+    _write(f"{repo}/b/BUILD", 'go_library(importpath = "example.com/b2")\n')
+    _write(f"{repo}/c.go", 'package c\n\nimport (\n\t"example.com/c"\n)\n')
+    monkeypatch.setattr(go, "import_refs_in_file", _counting(go.import_refs_in_file))
+
+    index = go.load_import_index()
+    assert index == go.build_import_index()
+    assert index == {
+        "foopb": "example.com/foo2",
+        "b2": "example.com/b2",
+        "c": "example.com/c",
+    }
+    assert go.import_refs_in_file.calls == 3
+
+    # Reverting a previously dirty file is picked up as well.
+    os.remove(f"{repo}/c.go")
+    assert go.load_import_index() == go.build_import_index()
+
+
+def test_unindexed_repos_are_listed_concurrently(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    repos = [str(tmp_path / name) for name in ("oss", "internal")]
+    for repo in repos:
+        _write(f"{repo}/a.go", 'package a\n\nimport (\n\t"example.com/a"\n)\n')
+        _git(repo, "init", "-q")
+        _git(repo, "add", "-A")
+        _git(repo, "commit", "-q", "-m", "init")
+    monkeypatch.setattr(go, "PATHS_TO_INDEX", repos)
+    listed = []
+
+    def map_concurrently(func, items):
+        if func is go.list_import_index_paths:
+            listed.append(items)
+        return [func(item) for item in items]
+
+    monkeypatch.setattr(tools, "map_concurrently", map_concurrently)
+    monkeypatch.setattr(
+        go, "list_import_index_paths", _counting(go.list_import_index_paths)
+    )
+
+    assert go.load_import_index() == {"a": "example.com/a"}
+    assert listed == [repos]
+    assert go.list_import_index_paths.calls == 2
+
+    # Repos which are already indexed aren't listed.
+    listed.clear()
+    repo_index.reset_repo_indexes()
+    assert go.load_import_index() == {"a": "example.com/a"}
+    assert listed == [[]]
+    assert go.list_import_index_paths.calls == 2
+
+
+def test_changes_to_unusual_paths_are_picked_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    repo = str(tmp_path / "repo")
+    # Git quotes these paths unless asked for NUL-terminated output.
+    a, b = f"{repo}/caf\u00e9/a.go", f'{repo}/b "x".go'
+    _write(a, 'package a\n\nimport (\n\tfoopb "example.com/foo"\n)\n')
+    _git(repo, "init", "-q")
+    _git(repo, "add", "-A")
+    _git(repo, "commit", "-q", "-m", "init")
+    monkeypatch.setattr(go, "PATHS_TO_INDEX", [repo])
+    go.load_import_index()
+
+    _write(a, 'package a\n\nimport (\n\tfoopb "example.com/foo2"\n)\n')
+    _write(b, 'package b\n\nimport (\n\t"example.com/b"\n)\n')
+    index = go.load_import_index()
+    assert index == go.build_import_index()
+    assert index == {"foopb": "example.com/foo2", "b": "example.com/b"}
+
+
+def test_unchanged_index_is_loaded_without_refs(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    repo = str(tmp_path / "repo")
+    _write(f"{repo}/a.go", 'package a\n\nimport (\n\tfoopb "example.com/foo"\n)\n')
+    _git(repo, "init", "-q")
+    _git(repo, "add", "-A")
+    _git(repo, "commit", "-q", "-m", "init")
+    _write(f"{repo}/b.go", 'package b\n\nimport (\n\t"example.com/b"\n)\n')
+    monkeypatch.setattr(go, "PATHS_TO_INDEX", [repo])
+    go.load_import_index()
+    # Building the index writes the refs without keeping them in memory.
+    assert go.load_repo_import_index(repo).refs_by_path is None
+    repo_index.reset_repo_indexes()
+    read_paths = []
+
+    def read_json(path):
+        read_paths.append(path)
+        return cache.read_json(path)
+
+    monkeypatch.setattr(repo_index, "read_json", read_json)
+
+    # Re-scanning a dirty file with the same imports doesn't read the refs.
+    _write(f"{repo}/b.go", 'package b\n\nimport (\n\t"example.com/b"\n)\n\n// x\n')
+    assert go.load_import_index() == go.build_import_index()
+    assert read_paths
+    assert not [path for path in read_paths if "go_import_index_refs" in path]
+
+    # Changed imports need the refs of all files.
+    repo_index.reset_repo_indexes()
+    _write(f"{repo}/b.go", 'package b\n\nimport (\n\t"example.com/b2"\n)\n')
+    assert go.load_import_index() == go.build_import_index()
+    assert [path for path in read_paths if "go_import_index_refs" in path]
+
+
+def test_unresolvable_symbols_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    repo = str(tmp_path / "repo")
+    _write(f"{repo}/a.go", 'package a\n\nimport (\n\tfoopb "example.com/foo"\n)\n')
+    _git(repo, "init", "-q")
+    _git(repo, "add", "-A")
+    _git(repo, "commit", "-q", "-m", "init")
+    monkeypatch.setattr(go, "PATHS_TO_INDEX", [repo])
+    path = f"{repo}/b.go"
+    _write(path, "package b\n\nvar x = barpb.X{}\n")
+    monkeypatch.setattr(
+        go, "get_source_file_info", lambda p: {"realpath": p} if p == path else None
+    )
+    error = f"{path}:3:9: undefined: barpb"
+
+    def new_run():
+        common.reset_source_files()
+        negative_cache.save_negative_cache()
+        negative_cache.reset_negative_cache()
+        repo_index.reset_repo_indexes()
+        go.reset_package_resolutions()
+
+    new_run()
+    assert not go.try_fix_error(error)
+
+    new_run()
+    monkeypatch.setattr(go, "package_resolutions", _counting(go.package_resolutions))
+    assert not go.try_fix_error(error)
+    assert go.package_resolutions.calls == 0
+
+    # Changing the file or the index invalidates the entry.
+    _write(path, "package b\n\n\nvar x = barpb.X{}\n")
+    new_run()
+    assert not go.try_fix_error(f"{path}:4:9: undefined: barpb")
+    assert go.package_resolutions.calls == 1
+
+    _write(f"{repo}/c.go", 'package c\n\nimport (\n\tbarpb "example.com/bar"\n)\n')
+    new_run()
+    with open(os.devnull, "w") as devnull:
+        monkeypatch.setattr("sys.stdout", devnull)
+        assert go.try_fix_error(f"{path}:4:9: undefined: barpb")
+
+
+def _counting(func):
+    def wrapper(*args):
+        wrapper.calls += 1
+        return func(*args)
+
+    wrapper.calls = 0
+    return wrapper
+
+
+def test_build_import_index_parallel(tmp_path, monkeypatch):
+    repo = str(tmp_path / "repo")
+    for i in range(10):
+        # Make some ref tokens ambiguous so that tie-breaking is exercised.
+        url = f"example.com/v{i % 3}/pkg{i % 4}"
+        _write(f"{repo}/p{i}/a.go", f'package p\n\nimport (\n\t"{url}"\n)\n')
+        _write(f"{repo}/p{i}/BUILD", f'go_library(importpath = "example.com/p{i}")\n')
+    _git(repo, "init", "-q")
+    monkeypatch.setattr(go, "PATHS_TO_INDEX", [repo])
+    monkeypatch.setattr(repo_index, "INDEX_CHUNK_SIZE", 3)
+
+    assert go.build_import_index_parallel(workers=4) == go.build_import_index()
+
+
+def test_fixes_are_batched(tmp_path, monkeypatch):
+    path = str(tmp_path / "foo.go")
+    _write(path, 'package foo\n\nimport (\n\t"os"\n)\n\nvar x = repb.Action{}\n')
+    monkeypatch.setattr(common, "WORKSPACE_DIRECTORY", str(tmp_path))
+
+    common.delete_line(path, 4)
+    go.add_import(path, "example.com/remote_execution", alias="repb")
+    go.add_import(path, "example.com/remote_execution", alias="repb")
+    common.apply_edits()
+
+    assert common.readlines(path) == [
+        "package foo\n",
+        "\n",
+        "import (\n",
+        '\trepb "example.com/remote_execution"\n',
+        ")\n",
+        "\n",
+        "var x = repb.Action{}\n",
+    ]
+
+
+def test_prefetch_loads_import_index_in_background(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(go, "_PACKAGE_RESOLUTIONS", None)
+    monkeypatch.setattr(go, "import_index_digest", lambda: "digest")
+    monkeypatch.setattr(
+        go,
+        "get_source_file_info",
+        lambda path: {"realpath": path} if os.path.exists(path) else None,
+    )
+    negative_cache.reset_negative_cache()
+    a, b = str(tmp_path / "a.go"), str(tmp_path / "b.go")
+    _write(a, "package a\n\nvar x = repb.Action{}\n")
+    _write(b, "package a\n\nvar y = repb.Action{}\n")
+    negative_cache.mark_unfixable(go.undefined_symbol_key(b, 3, "repb"))
+    loaded_on_threads = []
+    resolutions = {"repb": ("example.com/repb", "")}
+
+    def fake_load_import_index():
+        loaded_on_threads.append(threading.get_ident())
+        return resolutions
+
+    monkeypatch.setattr(go, "load_import_index", fake_load_import_index)
+
+    # Errors which adding an import can't fix don't load the index.
+    go.prefetch_error(f'{a}:3:2: "os" imported and not used')
+    go.prefetch_error(f"{a}:3:5: undefined: x")
+    go.prefetch_error(f"{a}:3:9: undefined: a")
+    go.prefetch_error(f"{tmp_path}/missing.go:3:9: undefined: repb")
+    go.prefetch_error(f"{b}:3:9: undefined: repb")
+    background.wait()
+    assert loaded_on_threads == []
+
+    go.prefetch_error(f"{a}:3:9: undefined: repb")
+    go.prefetch_error(f"{a}:3:9: undefined: repb")
+    background.wait()
+
+    assert go.package_resolutions() is resolutions
+    assert len(loaded_on_threads) == 1
+    assert loaded_on_threads[0] != threading.get_ident()
+    go.reset_prefetched_paths()
+    negative_cache.reset_negative_cache()
+
+
+def test_collapse_dirs():
+    assert go.collapse_dirs(["a/b", "a", "ab", "a/b/c", "ab", "c/d"]) == [
+        "a",
+        "ab",
+        "c/d",
+    ]
+    assert go.collapse_dirs(["a/b", ""]) == [""]
+
+
+def test_missing_imports_run_gazelle_once_per_workspace(monkeypatch, capsys):
+    runs = []
+
+    def fake_run(command):
+        assert command.capture and command.merge_stderr
+        runs.append((command.cwd, command.args))
+        return tools.Result(command, 0, f"{command.cwd} 1\n{command.cwd} 2\n".encode())
+
+    def fake_source_file_info(path):
+        workspace_path, relative_path = path.split(":")
+        return {
+            "workspace_path": workspace_path,
+            "workspace_relative_path": relative_path,
+        }
+
+    monkeypatch.setattr(go, "get_source_file_info", fake_source_file_info)
+    monkeypatch.setattr(tools, "run", fake_run)
+    common.reset_source_files()
+    go.reset_gazelle_dirs()
+
+    for path in [
+        "/oss:server/a/b/b.go",
+        "/oss:server/a/a.go",
+        "/oss:server/a/a_test.go",
+        "/oss:tools/t.go",
+        "/internal:enterprise/e/e.go",
+    ]:
+        assert go.try_fix_import(path, "example.com/x")
+    assert runs == []
+    common.apply_edits()
+
+    # Workspaces are processed concurrently, but their output isn't
+    # interleaved.
+    assert sorted(runs) == [
+        ("/internal", ["bazel", "run", "//:gazelle", "--", "enterprise/e"]),
+        ("/oss", ["bazel", "run", "//:gazelle", "--", "server/a", "tools"]),
+    ]
+    assert sorted(capsys.readouterr().err.split("gazelle output in ")) == [
+        "",
+        "/internal:\n/internal 1\n/internal 2\n",
+        "/oss:\n/oss 1\n/oss 2\n",
+    ]
+
+    # Dirs queued before the batches were reset are still updated.
+    runs.clear()
+    go.try_fix_import("/oss:server/a/a.go", "example.com/x")
+    common.reset_source_files()
+    go.try_fix_import("/oss:tools/t.go", "example.com/x")
+    common.apply_edits()
+    assert runs == [("/oss", ["bazel", "run", "//:gazelle", "--", "server/a", "tools"])]
+
+
+HEADER_WITH_SINGLE_LINE_IMPORTS = """// Copyright header.
+
+/*
+import "not/an/import"
+*/
+package foo
+
+import "fmt"
+import pb "example.com/proto"
+
+import (
+\t"context"
+\t_ "embed" // for go:embed
+)
+
+import ( "io" )
+
+func F() {}
+"""
+
+
+def test_go_file_imports_stops_reading_after_imports(tmp_path, monkeypatch):
+    path = str(tmp_path / "foo.go")
+    generated_code = 'var x = `\nimport "not/an/import"\n`\n' * 100_000
+    _write(path, HEADER_WITH_SINGLE_LINE_IMPORTS + generated_code)
+    lines_read = []
+
+    def open_recording(*args):
+        with open(*args) as f:
+            for line in f:
+                lines_read.append(line)
+                yield line
+
+    @contextlib.contextmanager
+    def fake_open(*args):
+        yield open_recording(*args)
+
+    monkeypatch.setattr(go, "open", fake_open, raising=False)
+
+    imports = go.go_file_imports(path)
+
+    # Reading stops at the first declaration after the imports.
+    assert "".join(lines_read) == HEADER_WITH_SINGLE_LINE_IMPORTS
+    assert imports == [
+        go.GoImport("fmt", None, None),
+        go.GoImport("example.com/proto", "pb", None),
+        go.GoImport("context", None, None),
+        go.GoImport("embed", "_", " for go:embed"),
+        go.GoImport("io", None, None),
+    ]
+
+
+LICENSED_FILE_WITH_TRICKY_IMPORTS = """// Copyright 2023 BuildBuddy Inc.
+//
+// Licensed under the Apache License.
+
+// Package foo does things (see also: bar).
+package foo // import "example.com/foo"
+
+import (
+	"fmt" /* ) */
+	strs "strings" // ) in a comment
+
+	// ) on its own
+	"example.com/a;b" ; "os"
+	. "example.com/dot"
+)
+
+import "C"
+
+import `example.com/raw`
+
+type T struct{}
+"""
+
+
+def test_parse_go_header():
+    lines = LICENSED_FILE_WITH_TRICKY_IMPORTS.splitlines(keepends=True)
+
+    header = go.parse_go_header(lines)
+
+    assert header.package_name == "foo"
+    assert header.package_line == 5
+    assert header.end == 20
+    assert header.comments == [
+        (0, 1),
+        (1, 2),
+        (2, 3),
+        (4, 5),
+        (5, 6),
+        (8, 9),
+        (9, 10),
+        (11, 12),
+    ]
+    assert header.import_decls == [
+        go.ImportDecl(
+            line_range=(7, 15),
+            imports=[
+                go.GoImport("fmt", None, None),
+                go.GoImport("strings", "strs", " ) in a comment"),
+                go.GoImport("example.com/a;b", None, None),
+                go.GoImport("os", None, None),
+                go.GoImport("example.com/dot", ".", None),
+            ],
+            grouped=True,
+        ),
+        go.ImportDecl(
+            line_range=(16, 17), imports=[go.GoImport("C", None, None)], grouped=False
+        ),
+        go.ImportDecl(
+            line_range=(18, 19),
+            imports=[go.GoImport("example.com/raw", None, None)],
+            grouped=False,
+        ),
+    ]
+    assert go.get_package_name(lines) == "foo"
+    assert go.get_imports(lines).line_range == (7, 15)
+
+
+def test_insert_import_into_single_line_import():
+    lines = ["package foo\n", "\n", 'import "fmt"\n', "\n", "func F() {}\n"]
+
+    assert go.insert_import(lines, "example.com/bar") == [
+        "package foo\n",
+        "\n",
+        "import (\n",
+        '\t"fmt"\n\n\t"example.com/bar"\n',
+        ")\n",
+        "\n",
+        "func F() {}\n",
+    ]
+
+
+def test_insert_import_twice():
+    lines = ["package foo\n", "\n", "func F() {}\n"]
+
+    # The header of the returned lines is parsed afresh, rather than reusing
+    # the one parsed before they were edited.
+    lines = go.insert_import(lines, "example.com/bar")
+    assert go.get_imports(lines).imports == [go.GoImport("example.com/bar", None, None)]
+    assert go.insert_import(lines, "example.com/baz") == [
+        "package foo\n",
+        "\n",
+        "import (\n",
+        '\t"example.com/bar"\n\t"example.com/baz"\n',
+        ")\n",
+        "\n",
+        "func F() {}\n",
+    ]
+
+
+def test_try_fix_error_imports_undefined_package(tmp_path, monkeypatch):
+    path = str(tmp_path / "foo.go")
+    _write(path, "package foo\n\nvar x = repb.Action{}\n")
+    monkeypatch.setattr(common, "WORKSPACE_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(go, "get_source_file_info", lambda p: {"realpath": path})
+    monkeypatch.setattr(
+        go, "package_resolutions", lambda: {"repb": "example.com/remote_execution"}
+    )
+    common.reset_source_files()
+
+    assert go.try_fix_error(f"{path}:3:9: undefined: repb")
+    assert not go.try_fix_error(f"{path}:3:9: undefined: foo")
+    common.apply_edits()
+
+    assert common.readlines(path) == [
+        "package foo\n",
+        "\n",
+        "import (\n",
+        '\trepb "example.com/remote_execution"\n',
+        ")\n",
+        "\n",
+        "var x = repb.Action{}\n",
+    ]
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Prints latency and hit rate percentiles for recent post_bazel runs.
+
+Each run appends a compact JSON record to METRICS_PATH, holding the log size,
+the time spent in each phase, how each import index was loaded, and the fixes
+found, attempted and applied per fixer. Records are appended rather than
+stored in a database so that writing one costs a single small write, even
+after successful builds. The file is rotated once it exceeds MAX_BYTES, keeping
+one previous generation.
+
+This is imported after every build, so it follows the import rules described
+at the top of post_bazel.py.
+"""
+
+import os
+import time
+
+import tracing
+from config import METRICS_PATH
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Any, Dict, List
+
+# Bump this whenever the format of records changes.
+METRICS_VERSION = 1
+
+MAX_BYTES = 16 << 20
+
+# Outcomes of loading an index which didn't require scanning any files.
+INDEX_HITS = ("memory", "disk")
+
+_RECORD: "Dict[str, Any]" = {}
+
+
+def _record() -> "Dict[str, Any]":
+    if not _RECORD:
+        _RECORD.update(
+            {"v": METRICS_VERSION, "phases": {}, "indexes": [], "fixers": {}}
+        )
+    return _RECORD
+
+
+class phase:
+    """Context manager which records the time spent in a phase of the run, and
+    a tracing span with the same name."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.span = tracing.span(self.name)
+        self.span.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        ms = (time.perf_counter() - self.start) * 1000
+        phases = _record()["phases"]
+        phases[self.name] = phases.get(self.name, 0) + ms
+        return self.span.__exit__(*exc_info)
+
+
+def set_value(name: str, value: "Any"):
+    _record()[name] = value
+
+
+def index_loaded(name: str, outcome: str, ms: float):
+    """Records how an index was loaded: from "memory" or "disk" if it was up to
+    date, or by an incremental "update" or full "build" otherwise."""
+    _record()["indexes"].append({"name": name, "outcome": outcome, "ms": ms})
+
+
+def _fixer(name: str) -> "Dict[str, Any]":
+    fixers = _record()["fixers"]
+    if name not in fixers:
+        fixers[name] = {"found": 0, "applied": 0, "ms": []}
+    return fixers[name]
+
+
+def fix_found(fixer: str):
+    _fixer(fixer)["found"] += 1
+
+
+def fix_attempted(fixer: str, applied: bool, ms: float):
+    stats = _fixer(fixer)
+    stats["ms"].append(ms)
+    if applied:
+        stats["applied"] += 1
+
+
+def write_record():
+    """Appends the record collected so far, and resets it for the next run."""
+    record = dict(_record())
+    _RECORD.clear()
+    if not METRICS_PATH:
+        return
+    import json
+
+    record["time"] = int(time.time())
+    for name, ms in record["phases"].items():
+        record["phases"][name] = round(ms, 2)
+    for index in record["indexes"]:
+        index["ms"] = round(index["ms"], 2)
+    for stats in record["fixers"].values():
+        stats["ms"] = [round(ms, 2) for ms in stats["ms"]]
+    line = json.dumps(record, separators=(",", ":")) + "\n"
+    try:
+        if not os.path.isdir(os.path.dirname(METRICS_PATH)):
+            from cache import make_private_dirs
+
+            make_private_dirs(os.path.dirname(METRICS_PATH))
+        fd = os.open(METRICS_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "a") as f:
+            # Writing a single line in append mode keeps records from
+            # concurrent builds intact.
+            f.write(line)
+            size = f.tell()
+        if size > MAX_BYTES:
+            os.replace(METRICS_PATH, METRICS_PATH + ".1")
+    except OSError:
+        pass
+
+
+def read_records(path: str) -> "List[Dict[str, Any]]":
+    """Returns the records in the given file and its previous generation,
+    oldest first, skipping any that are corrupt or from another version."""
+    import json
+
+    records = []
+    for generation in (path + ".1", path):
+        try:
+            with open(generation, "r") as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("v") == METRICS_VERSION:
+                records.append(record)
+    return records
+
+
+def percentile(values: "List[float]", p: float) -> float:
+    """Returns the nearest-rank percentile of the given values."""
+    import math
+
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def report(records: "List[Dict[str, Any]]") -> str:
+    if not records:
+        return "No runs recorded."
+    out = []
+    failed = sum(1 for r in records if r.get("build_failed"))
+    log_mb = [r.get("log_bytes", 0) / (1 << 20) for r in records]
+    out.append(
+        f"{len(records)} runs, {failed} failed builds, log size "
+        f"p50 {percentile(log_mb, 50):.1f} MB, p95 {percentile(log_mb, 95):.1f} MB"
+    )
+
+    phases: "Dict[str, List[float]]" = {}
+    for r in records:
+        for name, ms in r["phases"].items():
+            phases.setdefault(name, []).append(ms)
+    out.append("")
+    out.append(f"{'phase':<32} {'runs':>6} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, values in sorted(phases.items()):
+        out.append(
+            f"{name:<32} {len(values):>6} "
+            f"{percentile(values, 50):>9.1f} {percentile(values, 95):>9.1f}"
+        )
+
+    indexes: "Dict[str, List[Dict[str, Any]]]" = {}
+    for r in records:
+        for index in r["indexes"]:
+            indexes.setdefault(index["name"], []).append(index)
+    if indexes:
+        out.append("")
+        out.append(
+            f"{'index':<32} {'loads':>6} {'hit %':>6} {'builds':>6} "
+            f"{'p50 ms':>9} {'p95 ms':>9}"
+        )
+        for name, loads in sorted(indexes.items()):
+            hits = sum(1 for i in loads if i["outcome"] in INDEX_HITS)
+            builds = sum(1 for i in loads if i["outcome"] == "build")
+            values = [i["ms"] for i in loads]
+            out.append(
+                f"{name:<32} {len(loads):>6} {100 * hits / len(loads):>6.1f} "
+                f"{builds:>6} "
+                f"{percentile(values, 50):>9.1f} {percentile(values, 95):>9.1f}"
+            )
+
+    fixers: "Dict[str, Dict[str, Any]]" = {}
+    for r in records:
+        for name, stats in r["fixers"].items():
+            total = fixers.setdefault(name, {"found": 0, "applied": 0, "ms": []})
+            total["found"] += stats["found"]
+            total["applied"] += stats["applied"]
+            total["ms"].extend(stats["ms"])
+    if fixers:
+        out.append("")
+        out.append(
+            f"{'fixer':<32} {'found':>6} {'tried':>6} {'fixed %':>7} "
+            f"{'p50 ms':>9} {'p95 ms':>9}"
+        )
+        for name, stats in sorted(fixers.items()):
+            tried = len(stats["ms"])
+            if tried:
+                fixed = f"{100 * stats['applied'] / tried:>7.1f}"
+                p50 = f"{percentile(stats['ms'], 50):>9.1f}"
+                p95 = f"{percentile(stats['ms'], 95):>9.1f}"
+            else:
+                fixed, p50, p95 = f"{'-':>7}", f"{'-':>9}", f"{'-':>9}"
+            out.append(
+                f"{name:<32} {stats['found']:>6} {tried:>6} {fixed} {p50} {p95}"
+            )
+    return "\n".join(out)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--path", default=METRICS_PATH, help="metrics file")
+    parser.add_argument(
+        "--last", type=int, default=0, help="only report the last N runs"
+    )
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("metrics are disabled; pass --path")
+    records = read_records(args.path)
+    if args.last:
+        records = records[-args.last :]
+    print(report(records))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import metrics
+
+
+def _record_run(fix_ms):
+    with metrics.phase("scan_log"):
+        pass
+    metrics.set_value("log_bytes", 1 << 20)
+    metrics.set_value("build_failed", True)
+    metrics.index_loaded("go_import_index", "disk", 12.0)
+    metrics.fix_found("go.try_fix_error:undefined")
+    metrics.fix_found("go.try_fix_error:undefined")
+    metrics.fix_attempted("go.try_fix_error:undefined", True, fix_ms)
+    metrics.write_record()
+
+
+def test_records_are_appended_and_reported(tmp_path, monkeypatch):
+    path = str(tmp_path / "metrics.jsonl")
+    monkeypatch.setattr(metrics, "METRICS_PATH", path)
+    metrics._RECORD.clear()
+
+    for fix_ms in range(1, 21):
+        _record_run(float(fix_ms))
+    with open(path, "a") as f:
+        f.write('{"v": 1, "phases": {"scan_lo\n')
+
+    records = metrics.read_records(path)
+    assert len(records) == 20
+    assert records[0]["fixers"]["go.try_fix_error:undefined"] == {
+        "found": 2,
+        "applied": 1,
+        "ms": [1.0],
+    }
+
+    report = metrics.report(records).splitlines()
+    assert report[0] == "20 runs, 20 failed builds, log size p50 1.0 MB, p95 1.0 MB"
+    [index] = [line for line in report if line.startswith("go_import_index")]
+    assert index.split() == ["go_import_index", "20", "100.0", "0", "12.0", "12.0"]
+    [fixer] = [line for line in report if line.startswith("go.try_fix_error")]
+    assert fixer.split() == [
+        "go.try_fix_error:undefined",
+        "40",
+        "20",
+        "100.0",
+        "10.0",
+        "19.0",
+    ]
+
+
+def test_records_are_rotated(tmp_path, monkeypatch):
+    path = str(tmp_path / "metrics.jsonl")
+    monkeypatch.setattr(metrics, "METRICS_PATH", path)
+    monkeypatch.setattr(metrics, "MAX_BYTES", 1)
+    metrics._RECORD.clear()
+
+    _record_run(1.0)
+    _record_run(2.0)
+
+    assert not (tmp_path / "metrics.jsonl").exists()
+    assert len(metrics.read_records(path)) == 1
+
+
+def test_percentile():
+    assert metrics.percentile([3.0], 95) == 3.0
+    assert metrics.percentile([float(n) for n in range(1, 101)], 50) == 50.0
+    assert metrics.percentile([float(n) for n in range(1, 101)], 95) == 95.0
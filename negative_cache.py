@@ -0,0 +1,107 @@
+"""Persistent cache of errors which the plugin could not fix.
+
+The same broken line usually survives several edit-build cycles, so errors
+for which no fix was found are recorded here, and skipped on later runs
+without repeating the lookups. Keys include a hash of the file containing the
+error and the digest of any index that was consulted, so that an entry no
+longer matches as soon as either of them changes.
+
+The cache holds at most MAX_ENTRIES entries, evicting the least recently used.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Union
+
+import tracing
+from cache import cache_path, read_json, write_json
+from config import WORKSPACE_DIRECTORY
+
+# Bump this whenever the keys used by fixers change.
+NEGATIVE_CACHE_VERSION = 1
+
+MAX_ENTRIES = 4096
+
+_ENTRIES: Union["OrderedDict[str, None]", None] = None
+_CHANGED = False
+
+# Per-run memo of file path -> content hash.
+_FILE_DIGESTS: Dict[str, Union[str, None]] = {}
+
+
+def _cache_file() -> str:
+    return cache_path("negative_cache", WORKSPACE_DIRECTORY)
+
+
+def _entries() -> "OrderedDict[str, None]":
+    global _ENTRIES
+    if _ENTRIES is None:
+        value = read_json(_cache_file())
+        keys = []
+        if value and value.get("version") == NEGATIVE_CACHE_VERSION:
+            keys = value["keys"]
+        _ENTRIES = OrderedDict.fromkeys(keys)
+    return _ENTRIES
+
+
+def file_digest(path: str) -> Union[str, None]:
+    """Returns a hash of the file's contents, or None if it can't be read."""
+    if path not in _FILE_DIGESTS:
+        try:
+            with open(path, "rb") as f:
+                _FILE_DIGESTS[path] = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            _FILE_DIGESTS[path] = None
+    return _FILE_DIGESTS[path]
+
+
+def entry_key(*parts: Any) -> str:
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()[:24]
+
+
+def is_unfixable(key: str, record_hit: bool = True) -> bool:
+    """Returns whether the error with the given key was marked unfixable.
+
+    Pass record_hit=False when checking ahead of the fixer (e.g. to decide
+    whether to prefetch), so that hits are only counted once.
+    """
+    entries = _entries()
+    if key not in entries:
+        return False
+    # Hits only update the order in memory, which is persisted along with the
+    # next new entry, so that runs which only hit don't rewrite the cache.
+    entries.move_to_end(key)
+    if record_hit:
+        tracing.count("negative_cache_hits")
+    return True
+
+
+def mark_unfixable(key: str):
+    global _CHANGED
+    entries = _entries()
+    entries[key] = None
+    entries.move_to_end(key)
+    while len(entries) > MAX_ENTRIES:
+        entries.popitem(last=False)
+    _CHANGED = True
+
+
+def save_negative_cache():
+    global _CHANGED
+    if not _CHANGED:
+        return
+    write_json(
+        _cache_file(),
+        {"version": NEGATIVE_CACHE_VERSION, "keys": list(_entries())},
+    )
+    _CHANGED = False
+
+
+def reset_negative_cache():
+    """Forces the cache to be re-read from disk, and files to be re-hashed, on
+    next use."""
+    global _ENTRIES, _CHANGED
+    _ENTRIES = None
+    _CHANGED = False
+    _FILE_DIGESTS.clear()
@@ -0,0 +1,50 @@
+import os
+
+import cache
+import negative_cache
+
+
+def test_negative_cache_is_lru(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(negative_cache, "MAX_ENTRIES", 2)
+    negative_cache.reset_negative_cache()
+    a, b, c = (negative_cache.entry_key("test", n) for n in "abc")
+
+    negative_cache.mark_unfixable(a)
+    negative_cache.mark_unfixable(b)
+    assert negative_cache.is_unfixable(a)
+    negative_cache.mark_unfixable(c)
+    negative_cache.save_negative_cache()
+    negative_cache.reset_negative_cache()
+
+    assert negative_cache.is_unfixable(a)
+    assert not negative_cache.is_unfixable(b)
+    assert negative_cache.is_unfixable(c)
+
+
+def test_file_digest(tmp_path):
+    negative_cache.reset_negative_cache()
+    path = tmp_path / "a.go"
+    path.write_text("package a\n")
+    digest = negative_cache.file_digest(str(path))
+
+    path.write_text("package b\n")
+    assert negative_cache.file_digest(str(path)) == digest
+    negative_cache.reset_negative_cache()
+    assert negative_cache.file_digest(str(path)) != digest
+    assert negative_cache.file_digest(str(tmp_path / "missing.go")) is None
+
+
+def test_hits_do_not_rewrite_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    negative_cache.reset_negative_cache()
+    key = negative_cache.entry_key("test", "a")
+    negative_cache.mark_unfixable(key)
+    negative_cache.save_negative_cache()
+    negative_cache.reset_negative_cache()
+    (path,) = tmp_path.iterdir()
+    os.utime(path, ns=(0, 0))
+
+    assert negative_cache.is_unfixable(key)
+    negative_cache.save_negative_cache()
+    assert path.stat().st_mtime_ns == 0
@@ -1,102 +1,407 @@
 #!/usr/bin/env python3
 
+# This script runs after every build, and most builds succeed, so only the
+# modules needed to detect a successful build are imported up front. Fixer
+# modules are imported once a log line that they might fix is seen, and
+# annotations are quoted so that `typing` doesn't need to be imported: the
+# names they use are only imported under TYPE_CHECKING, which type checkers
+# treat as true. Other modules imported after every build follow the same
+# rules. post_bazel_test.py checks which modules are imported, and enforces an
+# import time budget when BB_DEV_PLUGINS_TIMING_TESTS=1.
+import importlib
 import os
 import re
 import sys
-from typing import List
+import time
 
-import go
-import ts
-from config import DEBUG
+import metrics
+import tracing
+from config import BEP_PATH, DAEMON, DEBUG, PIPELINE
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import BinaryIO, Iterator, List, Tuple, Union
 
 ANSI_ESCAPE_PATTERN = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
 
+# Summary lines printed by bazel at the end of a build. The last one in the log
+# determines the build status, whether it's found by reading the end of the
+# log or by scanning all of it.
+BUILD_FAILED_PATTERNS = [
+    re.compile(r"(ERROR|FAILED):.*Build did NOT complete successfully"),
+    re.compile(r"ERROR:.*Build failed. Not running target"),
+    re.compile(r"Executed \d+ out of \d+ tests?:.*?fails? to build"),
+]
+# Note: this also matches "Build completed, 1 test FAILED", since failing tests
+# don't produce any errors that we know how to fix.
+BUILD_SUCCEEDED_PATTERN = re.compile(r"INFO:.*Build completed")
+
+# Lines that don't contain any of these can't match any of the patterns above,
+# so they are skipped without being decoded or regex-matched.
+LINE_PREFILTERS = (b"Build", b"Executed", b".go:", b"strictDeps", b"TS2304")
+
+SUMMARY_PREFILTERS = (b"Build", b"Executed")
+
+# The log is read in blocks of this size so that memory usage doesn't depend
+# on the size of the log.
+LOG_CHUNK_SIZE = 1 << 20
+
+
+# The end of the log is read backwards in blocks of this size when looking for
+# the build summary, up to TAIL_MAX_BYTES in total.
+TAIL_BLOCK_SIZE = 64 * 1024
+TAIL_MAX_BYTES = 4 * 1024 * 1024
+
+# The build event JSON file is ignored if it was last written this long before
+# the log, since it was then written by an earlier command.
+BEP_MAX_AGE_S = 5
+
 
 class Fix:
-    def __init__(self, func, args):
+    def __init__(self, func, args, key_func=None, fixer=None):
         self.func = func
         self.args = args
+        self.key_func = key_func
+        # Name under which metrics are recorded for this fix.
+        self.fixer = fixer or func.__name__
+
+    def key(self) -> "Tuple":
+        """Identifies the error that this fixes. The first element of the
+        returned key, if any, is the path of the file to fix."""
+        key = self.key_func(*self.args) if self.key_func else None
+        return self.args if key is None else key
 
     def __call__(self):
-        return self.func(*self.args)
+        tracing.count("fixes_attempted")
+        start = time.perf_counter()
+        # Formatting the args isn't free, so only do it when tracing.
+        span_args = {"args": repr(self.args)} if tracing.ENABLED else {}
+        with tracing.span(self.func.__name__, **span_args):
+            result = self.func(*self.args)
+        ms = (time.perf_counter() - start) * 1000
+        metrics.fix_attempted(self.fixer, result in (None, True), ms)
+        return result
+
 
+class LineMatcher:
+    """Matches log lines against a pattern defined by a fixer module.
 
-def is_build_failed_line(line):
-    if re.search(
-        r"(ERROR|INFO|FAILED):.*Build (completed|did NOT complete) successfully", line
+    The fixer module is only imported once a line containing `token` is seen.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        module_name: str,
+        pattern_name: str,
+        fix_name: str,
+        key_name: "Union[str, None]" = None,
+        prefetch_name: "Union[str, None]" = None,
+        kind_name: "Union[str, None]" = None,
     ):
+        self.token = token
+        self.module_name = module_name
+        self.pattern_name = pattern_name
+        self.fix_name = fix_name
+        # Optional function which takes the same args as the fix function, and
+        # returns a normalized key used to dedupe fixes. See Fix.key.
+        self.key_name = key_name
+        # Optional function which takes the same args as the fix function, and
+        # starts loading anything the fix will need in the background.
+        self.prefetch_name = prefetch_name if PIPELINE else None
+        # Optional function which takes the same args as the fix function, and
+        # returns the kind of error, so that metrics are recorded per kind.
+        self.kind_name = kind_name
+        self.fixer = f"{module_name}.{fix_name}"
+        self._pattern = None
+        self._fix = None
+        self._key = None
+        self._prefetch = None
+        self._kind = None
+
+    def match(self, line: str) -> "Union[Fix, None]":
+        if self.token not in line:
+            return None
+        if self._pattern is None:
+            module = importlib.import_module(self.module_name)
+            self._pattern = re.compile(getattr(module, self.pattern_name))
+            self._fix = getattr(module, self.fix_name)
+            if self.key_name:
+                self._key = getattr(module, self.key_name)
+            if self.prefetch_name:
+                self._prefetch = getattr(module, self.prefetch_name)
+            if self.kind_name:
+                self._kind = getattr(module, self.kind_name)
+        match = self._pattern.search(line)
+        if not match:
+            return None
+        # Fix functions take the whole line if the pattern has no groups.
+        args = match.groups() or (line,)
+        if self._prefetch:
+            self._prefetch(*args)
+        fixer = self.fixer
+        if self._kind:
+            fixer += ":" + self._kind(*args)
+        metrics.fix_found(fixer)
+        return Fix(self._fix, args, self._key, fixer)
+
+
+# TODO: encapsulate line-matching logic into fixes themselves
+LINE_MATCHERS = [
+    LineMatcher(
+        ".go:",
+        "go",
+        "LINE_PATTERN",
+        "try_fix_error",
+        "error_key",
+        prefetch_name="prefetch_error",
+        kind_name="error_kind",
+    ),
+    LineMatcher(
+        ".go:", "go", "MISSING_IMPORT_PATTERN", "try_fix_import", "import_key"
+    ),
+    LineMatcher("strictDeps", "ts", "MISSING_IMPORT_PATTERN", "try_fix_import"),
+    LineMatcher(
+        "TS2304",
+        "ts",
+        "CANNOT_FIND_NAME_PATTERN",
+        "try_fix_cannot_find_name",
+        prefetch_name="prefetch_cannot_find_name",
+    ),
+]
+
+LINE_MATCHER_TOKENS = tuple(matcher.token for matcher in LINE_MATCHERS)
+
+
+def build_status(line: str) -> "Union[bool, None]":
+    """Returns whether the build failed if the line is a summary line, or None
+    otherwise."""
+    if any(pattern.search(line) for pattern in BUILD_FAILED_PATTERNS):
         return True
-    if re.search(r"ERROR:.*Build failed. Not running target", line):
-        return True
-    if re.search(r"Executed \d+ out of \d+ tests?:.*?fails? to build", line):
-        return True
-    return False
+    if BUILD_SUCCEEDED_PATTERN.search(line):
+        return False
+    return None
 
 
 def plaintext(text):
     line = re.sub(ANSI_ESCAPE_PATTERN, "", text)
-    line = re.sub(r"\r", "", text)
+    line = re.sub(r"\r", "", line)
     return line
 
 
-def main():
-    os.umask(0)
+def tail_lines(f: "BinaryIO") -> "Iterator[bytes]":
+    """Yields lines from the last TAIL_MAX_BYTES of the log, last line first."""
+    pos = f.seek(0, os.SEEK_END)
+    stop = max(0, pos - TAIL_MAX_BYTES)
+    partial = b""
+    while pos > stop:
+        size = min(TAIL_BLOCK_SIZE, pos - stop)
+        pos -= size
+        f.seek(pos)
+        lines = (f.read(size) + partial).splitlines()
+        # The first line in the block may be continued in the previous block.
+        partial = lines.pop(0) if pos > 0 and lines else b""
+        yield from reversed(lines)
 
-    fixes_to_apply: List[Fix] = []
 
-    bazel_logs_path = sys.argv[1]
-    with open(bazel_logs_path, "r") as f:
-        lines = f.readlines()
+def build_status_from_summary(f: "BinaryIO") -> "Union[bool, None]":
+    """Determines whether the build failed from the summary at the end of the
+    log.
 
-    is_build_failed = any((is_build_failed_line(plaintext(line)) for line in lines))
-    if not is_build_failed:
+    Returns None if no summary was found, in which case the whole log needs to
+    be scanned.
+    """
+    for line in tail_lines(f):
+        if not any(token in line for token in SUMMARY_PREFILTERS):
+            continue
+        status = build_status(plaintext(line.decode("utf-8", errors="replace")))
+        if status is not None:
+            return status
+    return None
+
+
+def _candidate_lines(block: bytes) -> "Iterator[str]":
+    if not any(token in block for token in LINE_PREFILTERS):
         return
+    for line in block.splitlines():
+        if any(token in line for token in LINE_PREFILTERS):
+            yield line.decode("utf-8", errors="replace")
+
+
+def candidate_lines(f: "BinaryIO") -> "Iterator[str]":
+    """Yields lines from the log which might match one of the scan patterns.
+
+    Whole blocks which don't contain any interesting tokens are skipped
+    without being split into lines.
+    """
+    remainder = b""
+    while chunk := f.read(LOG_CHUNK_SIZE):
+        chunk = remainder + chunk
+        end = chunk.rfind(b"\n") + 1
+        remainder = chunk[end:]
+        yield from _candidate_lines(chunk[:end])
+    yield from _candidate_lines(remainder)
+
+
+def match_fixes(line: str) -> "Iterator[Fix]":
+    for matcher in LINE_MATCHERS:
+        fix = matcher.match(line)
+        if fix:
+            yield fix
+
 
-    for line in lines:
+def scan_log(f: "BinaryIO") -> "Tuple[bool, List[Fix]]":
+    """Scans the bazel log in a single pass.
+
+    Returns whether the build failed, along with the fixes that can be tried
+    for errors found in the log.
+    """
+    is_build_failed = False
+    fixes = []
+    for line in candidate_lines(f):
+        tracing.count("candidate_lines")
         line = plaintext(line)
 
-        # TODO: encapsulate line-matching logic into fixes themselves
-        match = re.search(go.LINE_PATTERN, line)
-        if match:
-            fixes_to_apply.append(Fix(go.try_fix_error, (line,)))
-
-        # Disabling Gazelle for now (this is handled by the go-deps plugin)
-        # match = re.search(go.MISSING_IMPORT_PATTERN, line)
-        # if match:
-        #     fixes_to_apply.append(
-        #         Fix(go.try_fix_import, (match.group(1), match.group(2)))
-        #     )
-
-        match = re.search(ts.MISSING_IMPORT_PATTERN, line)
-        if match:
-            fixes_to_apply.append(
-                Fix(ts.try_fix_import, (match.group(1), match.group(2)))
-            )
-
-        match = re.search(ts.CANNOT_FIND_NAME_PATTERN, line)
-        if match:
-            fixes_to_apply.append(
-                Fix(ts.fix_cannot_find_name, (match.group(1), match.group(2)))
-            )
+        status = build_status(line)
+        if status is not None:
+            is_build_failed = status
+
+        fixes.extend(match_fixes(line))
+
+    tracing.count("log_bytes", f.tell())
+    tracing.count("fixes_found", len(fixes))
+    return is_build_failed, fixes
+
+
+def dedupe_fixes(fixes: "List[Fix]") -> "List[Fix]":
+    """Drops fixes for errors which were already reported, e.g. once per
+    configuration or test target, and groups the remaining fixes by file.
+
+    Fixes are otherwise kept in the order they were found.
+    """
+    # Drop exact repeats first, so that keys are only computed once per
+    # distinct error line.
+    distinct = {}
+    for fix in fixes:
+        distinct.setdefault((fix.func, fix.args), fix)
+    by_key = {}
+    for fix in distinct.values():
+        by_key.setdefault((fix.func, fix.key()), fix)
+    by_file = {}
+    for (_, key), fix in by_key.items():
+        by_file.setdefault(key[0] if key else None, []).append(fix)
+    tracing.count("fixes_deduped", len(fixes) - len(by_key))
+    return [fix for file_fixes in by_file.values() for fix in file_fixes]
+
+
+def scan_build_events(
+    bep_path: str, bazel_logs_path: str
+) -> "Union[Tuple[bool, List[Fix]], None]":
+    """Finds fixes using the build event JSON file written by bazel.
+
+    Returns None if the file is unavailable or incomplete, in which case the
+    console log should be scanned instead.
+    """
+    import bep
+
+    if bep.is_stale(bep_path, bazel_logs_path, BEP_MAX_AGE_S):
+        return None
+    with open(bep_path, "rb") as f:
+        with metrics.phase("read_build_events"):
+            result = bep.read_build_events(f)
+    if result is None:
+        return None
+    is_build_failed, error_lines = result
+    if not is_build_failed:
+        return False, []
+    fixes = []
+    for line in error_lines:
+        if any(token in line for token in LINE_MATCHER_TOKENS):
+            fixes.extend(match_fixes(plaintext(line)))
+    tracing.count("fixes_found", len(fixes))
+    return True, fixes
+
+
+def scan_console_log(bazel_logs_path: str) -> "Tuple[bool, List[Fix]]":
+    with open(bazel_logs_path, "rb") as f:
+        # Fast path: successful builds are by far the most common, and can be
+        # detected by looking only at the end of the log.
+        with metrics.phase("build_status_from_summary"):
+            summary_build_failed = build_status_from_summary(f)
+        if summary_build_failed is False:
+            return False, []
+        f.seek(0)
+        with metrics.phase("scan_log"):
+            is_build_failed, fixes = scan_log(f)
+    return bool(summary_build_failed or is_build_failed), fixes
+
+
+def run(bazel_logs_path: str):
+    result = None
+    if BEP_PATH:
+        result = scan_build_events(BEP_PATH, bazel_logs_path)
+    if result is None:
+        result = scan_console_log(bazel_logs_path)
+    is_build_failed, fixes_to_apply = result
+    metrics.set_value("log_bytes", os.path.getsize(bazel_logs_path))
+    metrics.set_value("build_failed", is_build_failed)
 
     if not fixes_to_apply:
         return
 
+    # Fixers may have started loading indexes and source files while the log
+    # was being scanned. Fixes may chdir, so they can't overlap with that work.
+    from background import wait
+
+    wait()
+
+    if not is_build_failed:
+        return
+
+    with metrics.phase("dedupe_fixes"):
+        fixes_to_apply = dedupe_fixes(fixes_to_apply)
+
     if DEBUG:
         for fix in fixes_to_apply:
             print(f"- {fix.func.__name__}{repr(fix.args)}")
 
-    fixed = False
-    for fix in fixes_to_apply:
-        fixed = fix()
-        if fixed is None or fixed == True:
-            # Only apply at most one fix at a time. Otherwise source
-            # files get too messed up.
-            # TODO: Improve logic so that multiple fixes can be applied at once.
-            break
+    # Edits are batched and line numbers refer to the original files, so every
+    # recognized error can be fixed in a single pass.
+    from common import apply_edits
+    from negative_cache import save_negative_cache
+    from workspace import save_BUILD_index
+
+    with metrics.phase("apply_fixes"):
+        for fix in fixes_to_apply:
+            if fix() in (None, True):
+                tracing.count("fixes_applied")
+    with metrics.phase("apply_edits"):
+        apply_edits()
+    with metrics.phase("save_BUILD_index"):
+        save_BUILD_index()
+    with metrics.phase("save_negative_cache"):
+        save_negative_cache()
 
     # TODO: print the fix here, instead of in fixes themselves
 
 
+def main():
+    os.umask(0)
+
+    bazel_logs_path = os.path.abspath(sys.argv[1])
+    if DAEMON:
+        import daemon
+
+        if daemon.run_in_daemon(bazel_logs_path):
+            return
+    with tracing.profile():
+        try:
+            with metrics.phase("post_bazel"):
+                run(bazel_logs_path)
+        finally:
+            tracing.write_trace()
+            metrics.write_record()
+
+
 if __name__ == "__main__":
     main()
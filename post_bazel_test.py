@@ -0,0 +1,247 @@
+import io
+import os
+import re
+import subprocess
+import sys
+from collections import Counter
+
+import pytest
+
+import go
+import metrics
+import post_bazel
+import tracing
+import ts
+
+# Budget for importing post_bazel.py, which happens after every build.
+STARTUP_IMPORT_BUDGET_US = 50_000
+
+# Modules which must not be imported when the build succeeded.
+NOOP_FORBIDDEN_MODULES = ["go", "ts", "common", "workspace", "daemon", "typing"]
+
+FAILED_BUILD_LOG = b"""\x1b[32mINFO: \x1b[0mAnalyzed target //server:server.
+\x1b[32m[1 / 5]\x1b[0m Compiling\r\x1b[1A\x1b[K
+server/foo.go:12:3: "os" imported and not used
+app/foo.tsx:3:5 - error TS2304: Cannot find name 'router'.
+\x1b[31m\x1b[1mERROR: \x1b[0mBuild did NOT complete successfully
+"""
+
+
+@pytest.fixture(autouse=True)
+def prefetched(monkeypatch):
+    """Records prefetches instead of loading indexes in the background."""
+    prefetched = []
+    monkeypatch.setattr(go, "prefetch_error", lambda *a: prefetched.append(a))
+    monkeypatch.setattr(
+        ts, "prefetch_cannot_find_name", lambda *a: prefetched.append(a)
+    )
+    _reload_matchers(monkeypatch)
+    return prefetched
+
+
+def _reload_matchers(monkeypatch):
+    for matcher in post_bazel.LINE_MATCHERS:
+        monkeypatch.setattr(matcher, "_pattern", None)
+        monkeypatch.setattr(matcher, "_fix", None)
+
+
+def test_scan_log():
+    is_build_failed, fixes = post_bazel.scan_log(io.BytesIO(FAILED_BUILD_LOG))
+
+    assert is_build_failed
+    assert [(fix.func, fix.args) for fix in fixes] == [
+        (go.try_fix_error, ('server/foo.go:12:3: "os" imported and not used',)),
+        (ts.try_fix_cannot_find_name, ("app/foo.tsx", "router")),
+    ]
+
+
+def test_scan_log_spanning_chunks(monkeypatch):
+    monkeypatch.setattr(post_bazel, "LOG_CHUNK_SIZE", 7)
+    log = b"INFO: noise\n" * 10 + FAILED_BUILD_LOG
+
+    _, fixes = post_bazel.scan_log(io.BytesIO(log))
+    _, expected_fixes = post_bazel.scan_log(io.BytesIO(FAILED_BUILD_LOG))
+
+    assert [f.args for f in fixes] == [f.args for f in expected_fixes]
+
+
+def test_scan_log_without_summary():
+    log = b"server/foo.go:12:3: undefined: os\nINFO: Elapsed time: 0.1s\n"
+
+    is_build_failed, fixes = post_bazel.scan_log(io.BytesIO(log))
+
+    assert not is_build_failed
+    assert len(fixes) == 1
+
+
+def test_dedupe_fixes(monkeypatch):
+    def fake_source_file_info(path):
+        return {"realpath": "/repo/" + path.split("/execroot/buildbuddy/")[-1]}
+
+    monkeypatch.setattr(go, "get_source_file_info", fake_source_file_info)
+    sandbox = "/sandbox/linux-sandbox/{}/execroot/buildbuddy"
+    log = (
+        f'{sandbox.format(1)}/server/a.go:4:2: "os" imported and not used\n'
+        f'{sandbox.format(1)}/server/a.go:4:2: "os" imported and not used\n'
+        f'{sandbox.format(2)}/server/a.go:4:2: "os" imported and not used\n'
+        f"{sandbox.format(2)}/server/b.go:9:2: undefined: repb\n"
+        f"{sandbox.format(2)}/server/a.go:7:2: undefined: repb\n"
+        f"{sandbox.format(3)}/server/b.go:9:2: undefined: repb\n"
+        "app/foo.tsx:3:5 - error TS2304: Cannot find name 'router'.\n"
+        "app/foo.tsx:8:5 - error TS2304: Cannot find name 'router'.\n"
+    ).encode()
+
+    _, fixes = post_bazel.scan_log(io.BytesIO(log))
+    fixes = post_bazel.dedupe_fixes(fixes)
+
+    assert [fix.key() for fix in fixes] == [
+        ("/repo/server/a.go", 4, '"os" imported and not used'),
+        ("/repo/server/a.go", 7, "undefined: repb"),
+        ("/repo/server/b.go", 9, "undefined: repb"),
+        ("app/foo.tsx", "router"),
+    ]
+
+
+def test_scan_log_prefetches_as_errors_are_found(prefetched):
+    _, fixes = post_bazel.scan_log(io.BytesIO(FAILED_BUILD_LOG))
+
+    assert len(fixes) == 2
+    assert prefetched == [
+        ('server/foo.go:12:3: "os" imported and not used',),
+        ("app/foo.tsx", "router"),
+    ]
+    assert [fix.fixer for fix in fixes] == [
+        "go.try_fix_error:unused_import",
+        "ts.try_fix_cannot_find_name",
+    ]
+
+
+def test_run_prefers_build_events(tmp_path, monkeypatch):
+    log_path = tmp_path / "bazel.log"
+    log_path.write_bytes(FAILED_BUILD_LOG)
+    bep_path = tmp_path / "bep.json"
+    monkeypatch.setattr(post_bazel, "BEP_PATH", str(bep_path))
+    applied = []
+    monkeypatch.setattr(ts, "try_fix_cannot_find_name", lambda *a: applied.append(a))
+    monkeypatch.setattr(go, "try_fix_error", lambda *a: applied.append(a))
+    _reload_matchers(monkeypatch)
+
+    # Stale or missing build events fall back to scanning the log.
+    post_bazel.run(str(log_path))
+    assert len(applied) == 2
+
+    applied.clear()
+    bep_path.write_text(
+        '{"id":{"actionCompleted":{}},"action":{"success":false,'
+        '"stderr":{"contents":"YXBwL2Zvby50c3g6MzoxIC0gZXJyb3IgVFMyMzA0OiBDYW5ub3Qg'
+        'ZmluZCBuYW1lICd4Jy4="}}}\n'
+        '{"id":{"buildFinished":{}},"finished":{"exitCode":{"code":1}}}\n'
+    )
+    post_bazel.run(str(log_path))
+    assert applied == [("app/foo.tsx", "x")]
+
+    # So does stderr which isn't available locally, e.g. from remote actions.
+    applied.clear()
+    bep_path.write_text(
+        '{"id":{"actionCompleted":{}},"action":{"success":false,'
+        '"stderr":{"uri":"bytestream://cache/blobs/x/1"}}}\n'
+        '{"id":{"buildFinished":{}},"finished":{"exitCode":{"code":1}}}\n'
+    )
+    post_bazel.run(str(log_path))
+    assert len(applied) == 2
+
+
+def test_fix_formats_args_only_when_tracing(monkeypatch):
+    class Arg:
+        reprs = 0
+
+        def __repr__(self):
+            Arg.reprs += 1
+            return "Arg()"
+
+    fix = post_bazel.Fix(lambda arg: True, (Arg(),))
+    monkeypatch.setattr(tracing, "ENABLED", False)
+    assert fix()
+    assert Arg.reprs == 0
+
+    monkeypatch.setattr(tracing, "ENABLED", True)
+    monkeypatch.setattr(tracing, "_EVENTS", [])
+    monkeypatch.setattr(tracing, "_COUNTERS", Counter())
+    assert fix()
+    assert Arg.reprs == 1
+
+
+def test_build_status_from_summary(monkeypatch):
+    monkeypatch.setattr(post_bazel, "TAIL_BLOCK_SIZE", 16)
+    succeeded = b"INFO: noise\n" * 100 + (
+        b"\x1b[32mINFO: \x1b[0mBuild completed successfully, 3 total actions\n"
+        b"//server:foo_test  PASSED in 0.1s\n"
+        b"Executed 1 out of 1 test: 1 test passes.\n"
+    )
+    failed = FAILED_BUILD_LOG + b"Executed 0 out of 1 test: 1 fails to build.\n"
+
+    assert post_bazel.build_status_from_summary(io.BytesIO(succeeded)) is False
+    assert post_bazel.build_status_from_summary(io.BytesIO(failed)) is True
+    assert post_bazel.build_status_from_summary(io.BytesIO(b"INFO: noise\n")) is None
+    assert post_bazel.build_status_from_summary(io.BytesIO(b"")) is None
+
+    # Scanning the whole log gives the same status.
+    assert post_bazel.scan_log(io.BytesIO(succeeded))[0] is False
+    assert post_bazel.scan_log(io.BytesIO(failed))[0] is True
+
+
+def test_build_status_from_summary_only_reads_tail(monkeypatch):
+    monkeypatch.setattr(post_bazel, "TAIL_MAX_BYTES", 64)
+    log = b"ERROR: Build did NOT complete successfully\n" + b"INFO: noise\n" * 10
+
+    assert post_bazel.build_status_from_summary(io.BytesIO(log)) is None
+
+
+def _run_python(*args, **kwargs):
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=os.path.dirname(os.path.abspath(post_bazel.__file__)),
+        capture_output=True,
+        encoding="utf-8",
+        check=True,
+        **kwargs,
+    )
+
+
+@pytest.mark.skipif(
+    os.getenv("BB_DEV_PLUGINS_TIMING_TESTS") != "1",
+    reason="timing-sensitive; set BB_DEV_PLUGINS_TIMING_TESTS=1 to run",
+)
+def test_startup_import_time_budget():
+    # Take the best of a few runs to reduce noise from a busy machine.
+    import_times = []
+    for _ in range(3):
+        result = _run_python("-X", "importtime", "-c", "import post_bazel")
+        m = re.search(r"\|\s*(\d+) \| post_bazel$", result.stderr, re.MULTILINE)
+        import_times.append(int(m.group(1)))
+
+    assert min(import_times) < STARTUP_IMPORT_BUDGET_US
+
+
+def test_successful_build_does_not_load_fixers(tmp_path):
+    log_path = tmp_path / "bazel.log"
+    log_path.write_text("INFO: Build completed successfully, 1 total action\n")
+    script = (
+        "import sys; import post_bazel; post_bazel.main(); "
+        "print(' '.join(sys.modules))"
+    )
+
+    metrics_path = tmp_path / "metrics.jsonl"
+    env = {
+        **os.environ,
+        "BB_DEV_PLUGINS_DAEMON": "0",
+        "BB_DEV_PLUGINS_METRICS": str(metrics_path),
+    }
+    result = _run_python("-c", script, str(log_path), env=env)
+
+    loaded = set(result.stdout.split())
+    assert "post_bazel" in loaded
+    assert not loaded & set(NOOP_FORBIDDEN_MODULES)
+    [record] = metrics.read_records(str(metrics_path))
+    assert record["build_failed"] is False
+    assert "post_bazel" in record["phases"]
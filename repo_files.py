@@ -0,0 +1,76 @@
+import subprocess
+from dataclasses import dataclass
+from typing import List
+
+import tools
+import tracing
+
+# Lists tracked and untracked (but not ignored) files, tagging deleted files
+# with "R" so that they can be excluded, all in one git invocation.
+LS_FILES_ARGS = [
+    "git",
+    "ls-files",
+    "-z",
+    "-t",
+    "--cached",
+    "--others",
+    "--exclude-standard",
+    "--deleted",
+]
+
+
+@dataclass
+class RepoFiles:
+    """Files in a repo, split by kind. Paths are relative to the repo root."""
+
+    go_paths: List[str]
+    BUILD_paths: List[str]
+    ts_paths: List[str]
+
+
+def is_go_path(path: str) -> bool:
+    return path.endswith(".go")
+
+
+def is_BUILD_path(path: str) -> bool:
+    return path == "BUILD" or path.endswith("/BUILD")
+
+
+def is_ts_path(path: str) -> bool:
+    return (path.endswith(".ts") or path.endswith(".tsx")) and not path.endswith(
+        ".d.ts"
+    )
+
+
+def git_ls_files(repo_path: str) -> List[str]:
+    """Returns the paths of all existing, non-ignored files in the repo."""
+    # Use a dict to dedupe paths (e.g. unmerged paths appear once per stage)
+    # while preserving order.
+    paths = {}
+    deleted = set()
+    try:
+        for entry in tools.stream(tools.Command(LS_FILES_ARGS, repo_path), b"\0"):
+            if not entry:
+                continue
+            tag = entry[:1]
+            path = entry[2:].decode("utf-8", errors="surrogateescape")
+            if tag == b"R":
+                deleted.add(path)
+            else:
+                paths[path] = None
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [path for path in paths if path not in deleted]
+
+
+@tracing.traced("list_repo_files")
+def list_repo_files(repo_path: str) -> RepoFiles:
+    files = RepoFiles(go_paths=[], BUILD_paths=[], ts_paths=[])
+    for path in git_ls_files(repo_path):
+        if is_go_path(path):
+            files.go_paths.append(path)
+        elif is_BUILD_path(path):
+            files.BUILD_paths.append(path)
+        elif is_ts_path(path):
+            files.ts_paths.append(path)
+    return files
@@ -0,0 +1,29 @@
+import os
+import subprocess
+
+import repo_files
+
+
+def _write(path, content=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_list_repo_files(tmp_path):
+    repo = str(tmp_path)
+    for path in ["a.go", "deleted.go", "pkg/BUILD", "pkg/b.go", "pkg/BUILD.bazel"]:
+        _write(os.path.join(repo, path))
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@test"]
+    subprocess.run([*git, "init", "-q"], cwd=repo, check=True)
+    subprocess.run([*git, "add", "-A"], cwd=repo, check=True)
+    subprocess.run([*git, "commit", "-q", "-m", "init"], cwd=repo, check=True)
+    os.remove(os.path.join(repo, "deleted.go"))
+    _write(os.path.join(repo, ".gitignore"), "ignored.go\n")
+    _write(os.path.join(repo, "ignored.go"))
+    _write(os.path.join(repo, "untracked/c.go"))
+
+    files = repo_files.list_repo_files(repo)
+
+    assert sorted(files.go_paths) == ["a.go", "pkg/b.go", "untracked/c.go"]
+    assert files.BUILD_paths == ["pkg/BUILD"]
@@ -0,0 +1,457 @@
+"""Persistent, incrementally-updated per-repo indexes of import references.
+
+An index counts, for each key (e.g. the token a Go package is referenced by),
+how often each value (e.g. an import URL) appears across all indexed files in
+a repo. Indexes are keyed by the commit they were built from, and updated by
+re-scanning only the files that changed since then.
+
+Each index is stored in two files: a summary holding the counts, and the refs
+of every indexed file, which are only needed to update the counts once files
+change. Runs where no indexed file changed only read the summary.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from sys import intern
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+import metrics
+import tools
+import tracing
+from cache import cache_path, read_json, write_json, write_json_items
+from common import workdir
+from config import INDEX_WORKERS
+
+# (key, value) pair contributed to an index by a single import.
+IndexRef = Tuple[str, str]
+
+# Returns the refs in a file, given its path relative to the repo root (which
+# is the working directory). Must return [] for files of other kinds.
+ScanFunc = Callable[[str], List[IndexRef]]
+
+# Number of files handed to a worker process at a time. Large enough to
+# amortize IPC overhead, small enough to keep all workers busy.
+INDEX_CHUNK_SIZE = 256
+
+# A list of file paths relative to the repo path.
+FileChunk = Tuple[str, List[str]]
+
+# Receives the refs of each file as an index is built.
+RefsSink = Callable[[str, List[IndexRef]], None]
+
+
+def index_worker_count(workers: Union[int, None] = None) -> int:
+    if workers is None:
+        workers = INDEX_WORKERS
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def chunked(repo_path: str, paths: List[str]) -> List[FileChunk]:
+    return [
+        (repo_path, paths[i : i + INDEX_CHUNK_SIZE])
+        for i in range(0, len(paths), INDEX_CHUNK_SIZE)
+    ]
+
+
+def map_chunks(func, chunks: List, workers: Union[int, None] = None) -> Iterator:
+    """Maps func over chunks using a process pool, preserving chunk order.
+
+    Results are yielded as they're consumed, so that only the results of
+    chunks which are done but not yet consumed are held at once.
+    """
+    workers = min(index_worker_count(workers), len(chunks))
+    if workers <= 1:
+        yield from map(func, chunks)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(func, chunks)
+
+
+def _scan_chunk(
+    args: Tuple[ScanFunc, str, List[str]]
+) -> List[Tuple[str, List[IndexRef]]]:
+    scan, repo_path, paths = args
+    with workdir(repo_path):
+        return [(path, scan(path)) for path in paths]
+
+
+@dataclass
+class RepoIndex:
+    """Index of a single repo, as of a particular commit.
+
+    The counts reflect the working tree at the time the index was last
+    updated, which means they include uncommitted changes. `dirty_paths` lists
+    the paths which differed from `commit` at that time, so that they can be
+    re-scanned even if they have since been reverted, and `dirty_refs` holds
+    their refs, so that they can be compared without loading `refs_by_path`.
+
+    `refs_by_path` is None until it's loaded by load_refs.
+
+    `digest` is a hash of the counts, which only changes when they do, and
+    `tree_stamp` identifies the state of the working tree they reflect. See
+    working_tree_stamp.
+    """
+
+    commit: str
+    dirty_paths: List[str]
+    refs_by_path: Union[Dict[str, List[IndexRef]], None]
+    value_count_by_key: Dict[str, Counter]
+    dirty_refs: Dict[str, List[IndexRef]] = field(default_factory=dict)
+    digest: str = ""
+    # Identifies the refs file written along with this index.
+    refs_token: str = ""
+    tree_stamp: str = ""
+
+    def update_digest(self):
+        counts = json.dumps(self.value_count_by_key, sort_keys=True)
+        self.digest = hashlib.sha1(counts.encode("utf-8")).hexdigest()
+
+    def add_file(self, path: str, refs: List[IndexRef]):
+        if not refs:
+            return
+        # The same keys and values appear in many files, so share the strings.
+        refs = [(intern(key), intern(value)) for key, value in refs]
+        self.refs_by_path[path] = refs
+        self.count_refs(refs)
+
+    def count_refs(self, refs: List[IndexRef]):
+        for key, value in refs:
+            self.value_count_by_key.setdefault(key, Counter())[value] += 1
+
+    def remove_file(self, path: str):
+        for key, value in self.refs_by_path.pop(path, []):
+            value_count = self.value_count_by_key[key]
+            value_count[value] -= 1
+            if value_count[value] <= 0:
+                del value_count[value]
+            if not value_count:
+                del self.value_count_by_key[key]
+
+    def update_dirty_refs(self):
+        self.dirty_refs = {
+            path: self.refs_by_path[path]
+            for path in self.dirty_paths
+            if path in self.refs_by_path
+        }
+
+    def to_json(self, version: int):
+        return {
+            "version": version,
+            "commit": self.commit,
+            "dirty_paths": self.dirty_paths,
+            "dirty_refs": self.dirty_refs,
+            "value_count_by_key": self.value_count_by_key,
+            "digest": self.digest,
+            "refs_token": self.refs_token,
+        }
+
+    def refs_to_json(self, version: int):
+        return {
+            "version": version,
+            "refs_token": self.refs_token,
+            "refs_by_path": self.refs_by_path,
+        }
+
+    @staticmethod
+    def from_json(value, version: int) -> Union["RepoIndex", None]:
+        if not value or value.get("version") != version:
+            return None
+        return RepoIndex(
+            commit=value["commit"],
+            dirty_paths=value["dirty_paths"],
+            refs_by_path=None,
+            value_count_by_key={
+                key: Counter(value_count)
+                for key, value_count in value["value_count_by_key"].items()
+            },
+            dirty_refs={
+                path: [(key, value) for key, value in refs]
+                for path, refs in value["dirty_refs"].items()
+            },
+            digest=value["digest"],
+            refs_token=value["refs_token"],
+        )
+
+    def load_refs(self, value, version: int) -> bool:
+        """Loads refs_by_path from the JSON written along with this index.
+        Returns False if it's missing or was written along with another
+        index."""
+        if (
+            not value
+            or value.get("version") != version
+            or value.get("refs_token") != self.refs_token
+        ):
+            return False
+        self.refs_by_path = {
+            path: [(intern(key), intern(value)) for key, value in refs]
+            for path, refs in value["refs_by_path"].items()
+        }
+        return True
+
+
+def git_head_commit() -> Union[str, None]:
+    result = tools.run(tools.Command(["git", "rev-parse", "--verify", "HEAD"]))
+    if not result.ok:
+        return None
+    return result.text().strip()
+
+
+def git_changed_paths(commit: str) -> Union[List[str], None]:
+    """Returns paths which differ between the given commit and the working tree.
+
+    This includes committed, staged and unstaged changes, as well as untracked
+    files. Returns None if the commit is unknown (e.g. it was garbage
+    collected).
+    """
+    # With -z, paths are NUL-terminated rather than quoted, so that unusual
+    # paths match the ones listed by repo_files.
+    diff_args = ["git", "diff", "-z", "--name-only", "--no-renames", "--relative"]
+    untracked_args = ["git", "ls-files", "-z", "--others", "--exclude-standard"]
+    diff, untracked = tools.run_all(
+        [
+            tools.Command(diff_args + [commit, "--"]),
+            tools.Command(untracked_args),
+        ]
+    )
+    if not diff.ok:
+        return None
+    return [
+        path
+        for output in (diff.text(), untracked.text())
+        for path in output.split("\0")
+        if path
+    ]
+
+
+def working_tree_stamp(commit: str, dirty_paths: List[str]) -> str:
+    """Returns a hash of the commit and the sizes and modification times of
+    the dirty paths, which changes whenever any file in the repo might have.
+
+    Must be called from the repo root.
+    """
+    stamp = hashlib.sha1(commit.encode("utf-8"))
+    for path in dirty_paths:
+        try:
+            st = os.stat(path)
+            stamp.update(f"\0{path}\0{st.st_size}\0{st.st_mtime_ns}".encode("utf-8"))
+        except OSError:
+            stamp.update(f"\0{path}\0-".encode("utf-8"))
+    return stamp.hexdigest()
+
+
+@tracing.traced("build_repo_index")
+def build_repo_index(
+    commit: str,
+    paths: List[str],
+    scan: ScanFunc,
+    write_refs: Union[RefsSink, None] = None,
+) -> RepoIndex:
+    """Builds an index from scratch by scanning all the given paths.
+
+    The refs of each file are passed to `write_refs` (if any) rather than kept
+    in `refs_by_path`, which is left None, so that memory use doesn't grow
+    with the number of files.
+    """
+    index = RepoIndex(
+        commit=commit,
+        dirty_paths=sorted(set(git_changed_paths(commit) or [])),
+        refs_by_path=None,
+        value_count_by_key={},
+    )
+    dirty_paths = set(index.dirty_paths)
+    tracing.count("files_scanned", len(paths))
+    chunks = [
+        (scan, repo_path, chunk) for repo_path, chunk in chunked(os.getcwd(), paths)
+    ]
+    for scanned in map_chunks(_scan_chunk, chunks):
+        for path, refs in scanned:
+            if not refs:
+                continue
+            refs = [(intern(key), intern(value)) for key, value in refs]
+            index.count_refs(refs)
+            if path in dirty_paths:
+                index.dirty_refs[path] = refs
+            if write_refs:
+                write_refs(path, refs)
+    return index
+
+
+@tracing.traced("update_repo_index")
+def update_repo_index(
+    index: RepoIndex,
+    commit: str,
+    scan: ScanFunc,
+    load_refs: Callable[[RepoIndex], bool],
+) -> Union[bool, None]:
+    """Re-scans only the files that changed since the index was last updated.
+
+    The refs of all files are only loaded (using `load_refs`) if any refs
+    changed, or the commit did.
+
+    Returns whether the index changed, or None if the index could not be
+    updated incrementally.
+    """
+    changed_paths = git_changed_paths(index.commit)
+    if changed_paths is None:
+        return None
+    paths_to_rescan = sorted(set(changed_paths) | set(index.dirty_paths))
+    tracing.count("files_scanned", len(paths_to_rescan))
+    scanned = [
+        (path, scan(path) if os.path.isfile(path) else []) for path in paths_to_rescan
+    ]
+    dirty_paths = sorted(set(changed_paths))
+    if (
+        index.refs_by_path is None
+        and commit == index.commit
+        and dirty_paths == index.dirty_paths
+        and all(refs == index.dirty_refs.get(path, []) for path, refs in scanned)
+    ):
+        return False
+    if index.refs_by_path is None and not load_refs(index):
+        return None
+    changed = False
+    for path, refs in scanned:
+        if refs == index.refs_by_path.get(path, []):
+            continue
+        index.remove_file(path)
+        index.add_file(path, refs)
+        changed = True
+    if commit != index.commit:
+        # Re-key the index to the current commit so that the set of changed
+        # paths doesn't keep growing as new commits are made.
+        changed_paths = git_changed_paths(commit)
+        if changed_paths is None:
+            return None
+        dirty_paths = sorted(set(changed_paths))
+    changed = changed or commit != index.commit or dirty_paths != index.dirty_paths
+    index.commit = commit
+    index.dirty_paths = dirty_paths
+    index.update_dirty_refs()
+    return changed
+
+
+# (namespace, repo path) -> index, for indexes already loaded by this process.
+_REPO_INDEXES: Dict[Tuple[str, str], RepoIndex] = {}
+
+
+def load_repo_index(
+    namespace: str,
+    version: int,
+    repo_path: str,
+    list_paths: Callable[[str], List[str]],
+    scan: ScanFunc,
+) -> RepoIndex:
+    """Loads an index for the given repo from memory or disk, updating it
+    incrementally if it exists or building it from scratch otherwise.
+
+    `namespace` identifies the kind of index, and `version` must be bumped
+    whenever the refs returned by `scan` change for the same input.
+    """
+    start = time.perf_counter()
+    cache_file = cache_path(namespace, os.path.realpath(repo_path))
+    refs_file = cache_path(namespace + "_refs", os.path.realpath(repo_path))
+    digest_file = cache_path(namespace + "_digest", os.path.realpath(repo_path))
+
+    def load_refs(index: RepoIndex) -> bool:
+        with tracing.span("read_index_refs"):
+            return index.load_refs(read_json(refs_file), version)
+
+    def build(commit: str) -> RepoIndex:
+        # The refs are written as they're scanned rather than held in memory.
+        refs_token = os.urandom(8).hex()
+        fields = {"version": version, "refs_token": refs_token}
+        with write_json_items(refs_file, fields, "refs_by_path") as write_refs:
+            index = build_repo_index(commit, list_paths(repo_path), scan, write_refs)
+        index.refs_token = refs_token
+        return index
+
+    with workdir(repo_path), tracing.span(namespace, repo=repo_path):
+        commit = git_head_commit()
+        if commit is None:
+            # Not a git repo (or no commits yet); nothing to key the index on.
+            index = build_repo_index("", list_paths(repo_path), scan)
+            ms = (time.perf_counter() - start) * 1000
+            metrics.index_loaded(namespace, "build", ms)
+            return index
+        outcome = "memory"
+        index = _REPO_INDEXES.get((namespace, repo_path))
+        if index is None:
+            outcome = "disk"
+            with tracing.span("read_index"):
+                index = RepoIndex.from_json(read_json(cache_file), version)
+                index_digest = read_json(digest_file)
+            if index is not None and index_digest:
+                if index_digest.get("digest") == index.digest:
+                    index.tree_stamp = index_digest.get("stamp", "")
+        changed = None
+        if index is not None:
+            changed = update_repo_index(index, commit, scan, load_refs)
+            if changed:
+                outcome = "update"
+        if changed is None:
+            index = build(commit)
+            changed = True
+            outcome = "build"
+        tree_stamp = working_tree_stamp(index.commit, index.dirty_paths)
+    if changed:
+        index.update_digest()
+        with tracing.span("write_index"):
+            if index.refs_by_path is not None:
+                # Otherwise, the refs were written as the index was built.
+                index.refs_token = os.urandom(8).hex()
+                write_json(refs_file, index.refs_to_json(version))
+            write_json(cache_file, index.to_json(version))
+    if changed or tree_stamp != index.tree_stamp:
+        index.tree_stamp = tree_stamp
+        write_json(
+            digest_file,
+            {"version": version, "digest": index.digest, "stamp": tree_stamp},
+        )
+    _REPO_INDEXES[(namespace, repo_path)] = index
+    metrics.index_loaded(namespace, outcome, (time.perf_counter() - start) * 1000)
+    return index
+
+
+def has_repo_index(namespace: str, repo_path: str) -> bool:
+    """Returns whether an index for the given repo was loaded by this process
+    or stored on disk, i.e. whether loading it probably won't build it."""
+    if (namespace, repo_path) in _REPO_INDEXES:
+        return True
+    return os.path.exists(cache_path(namespace, os.path.realpath(repo_path)))
+
+
+def repo_index_digest(
+    namespace: str, version: int, repo_path: str
+) -> Union[str, None]:
+    """Returns the digest of the given index, without loading it.
+
+    Returns None unless the index was last loaded (by any process) from the
+    current state of the working tree, since the digest might be out of date
+    otherwise.
+    """
+    value = read_json(cache_path(namespace + "_digest", os.path.realpath(repo_path)))
+    if not value or value.get("version") != version:
+        return None
+    with workdir(repo_path), tracing.span("repo_index_digest", repo=repo_path):
+        commit = git_head_commit()
+        if commit is None:
+            return None
+        dirty_paths = git_changed_paths(commit)
+        if dirty_paths is None:
+            return None
+        tree_stamp = working_tree_stamp(commit, sorted(set(dirty_paths)))
+    if tree_stamp != value.get("stamp"):
+        return None
+    return value["digest"]
+
+
+def reset_repo_indexes():
+    """Discards all indexes loaded by this process."""
+    _REPO_INDEXES.clear()
@@ -0,0 +1,141 @@
+"""Runs external tools (git, buildozer, gazelle).
+
+Commands are run without a shell and are killed if they exceed their timeout.
+Independent commands can be run concurrently using run_all, and long outputs
+can be processed incrementally using stream.
+"""
+
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, TypeVar, Union
+
+import tracing
+from common import warn
+
+# How long a command may run before it's killed, unless overridden.
+DEFAULT_TIMEOUT_S = 60.0
+
+# Maximum number of commands (or functions) run at once.
+MAX_CONCURRENCY = 8
+
+# Size of the blocks in which streamed output is read.
+STREAM_BLOCK_SIZE = 64 * 1024
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass
+class Command:
+    args: List[str]
+    cwd: Union[str, None] = None
+    timeout: float = DEFAULT_TIMEOUT_S
+    # Whether to capture output. Otherwise, it goes straight to the terminal.
+    capture: bool = True
+    # Whether captured stderr is interleaved with stdout, rather than dropped.
+    merge_stderr: bool = False
+
+
+@dataclass
+class Result:
+    command: Command
+    # None if the command timed out or couldn't be started.
+    returncode: Union[int, None]
+    stdout: bytes = b""
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+    def text(self) -> str:
+        return self.stdout.decode("utf-8", errors="surrogateescape")
+
+
+def run(command: Command) -> Result:
+    output = subprocess.PIPE if command.capture else None
+    errors = subprocess.STDOUT if command.capture and command.merge_stderr else output
+    with tracing.span(command.args[0], args=" ".join(command.args[1:])):
+        try:
+            p = subprocess.run(
+                command.args,
+                cwd=command.cwd,
+                stdout=output,
+                stderr=errors,
+                timeout=command.timeout,
+            )
+        except subprocess.TimeoutExpired:
+            warn(f"{command.args[0]} timed out after {command.timeout:g}s")
+            return Result(command, None)
+        except OSError as e:
+            warn(f"Failed to run {command.args[0]}: {e}")
+            return Result(command, None)
+    return Result(command, p.returncode, p.stdout or b"")
+
+
+def map_concurrently(func: Callable[[T], R], items: List[T]) -> List[R]:
+    """Maps func over items using a bounded pool of threads, preserving order.
+
+    Intended for functions which mostly wait on external commands.
+    """
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), MAX_CONCURRENCY)) as pool:
+        return list(pool.map(func, items))
+
+
+def run_all(commands: List[Command]) -> List[Result]:
+    """Runs independent commands concurrently, returning results in order."""
+    return map_concurrently(run, commands)
+
+
+def stream(command: Command, separator: bytes = b"\n") -> Iterator[bytes]:
+    """Yields the command's output split by the separator (a single byte, so
+    that it can't straddle two reads), as it's produced.
+
+    Raises subprocess.TimeoutExpired or subprocess.CalledProcessError once the
+    output ends if the command timed out or failed.
+    """
+    with tracing.span(command.args[0], args=" ".join(command.args[1:])):
+        p = subprocess.Popen(
+            command.args,
+            cwd=command.cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            p.kill()
+
+        timer = threading.Timer(command.timeout, kill)
+        timer.start()
+        try:
+            # Blocks of an entry which hasn't ended yet. They're only joined
+            # once it ends, so long entries are copied once rather than once
+            # per block.
+            partial: List[bytes] = []
+            while block := p.stdout.read(STREAM_BLOCK_SIZE):
+                entries = block.split(separator)
+                if len(entries) > 1:
+                    partial.append(entries[0])
+                    entries[0] = b"".join(partial)
+                    partial.clear()
+                partial.append(entries.pop())
+                yield from entries
+            tail = b"".join(partial)
+            if tail:
+                yield tail
+            returncode = p.wait()
+        finally:
+            timer.cancel()
+            if p.poll() is None:
+                p.kill()
+            p.stdout.close()
+            p.wait()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(command.args, command.timeout)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command.args)
@@ -0,0 +1,54 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+import tools
+
+
+def _python(code, **kwargs):
+    return tools.Command([sys.executable, "-c", code], **kwargs)
+
+
+def test_run():
+    result = tools.run(_python("print('hello')"))
+    assert result.ok
+    assert result.text() == "hello\n"
+
+    assert tools.run(_python("raise SystemExit(3)")).returncode == 3
+    assert tools.run(tools.Command(["/nonexistent/tool"])).returncode is None
+
+    code = "import sys; print('out', flush=True); sys.stderr.write('err')"
+    assert tools.run(_python(code)).text() == "out\n"
+    assert tools.run(_python(code, merge_stderr=True)).text() == "out\nerr"
+
+
+def test_run_times_out():
+    start = time.monotonic()
+    result = tools.run(_python("import time; time.sleep(10)", timeout=0.2))
+    assert result.returncode is None
+    assert time.monotonic() - start < 5
+
+
+def test_run_all_is_concurrent():
+    commands = [_python(f"import time; time.sleep(0.5); print({i})") for i in range(4)]
+
+    start = time.monotonic()
+    results = tools.run_all(commands)
+
+    assert [r.text() for r in results] == ["0\n", "1\n", "2\n", "3\n"]
+    assert time.monotonic() - start < 1.5
+
+
+def test_stream(monkeypatch):
+    monkeypatch.setattr(tools, "STREAM_BLOCK_SIZE", 3)
+    command = _python("import sys; sys.stdout.write('a\\0bcdef\\0g')")
+    assert list(tools.stream(command, b"\0")) == [b"a", b"bcdef", b"g"]
+    command = _python("import sys; sys.stdout.write('ab\\0\\0cdefgh\\0')")
+    assert list(tools.stream(command, b"\0")) == [b"ab", b"", b"cdefgh"]
+
+    with pytest.raises(subprocess.CalledProcessError):
+        list(tools.stream(_python("print('x'); raise SystemExit(1)")))
+    with pytest.raises(subprocess.TimeoutExpired):
+        list(tools.stream(_python("import time; time.sleep(10)", timeout=0.2)))
@@ -0,0 +1,131 @@
+"""Timing spans and counters for diagnosing slow runs.
+
+Tracing is enabled by setting BB_DEV_PLUGINS_TRACE to a file path, which a
+Chrome trace (viewable in chrome://tracing or https://ui.perfetto.dev) is
+written to at the end of each run. Setting BB_DEV_PLUGINS_PROFILE to a file
+path writes a cProfile dump instead (viewable with `python3 -m pstats`).
+
+When tracing is disabled, span() returns a shared no-op context manager and
+traced() returns the decorated function unchanged, so instrumentation costs
+next to nothing.
+"""
+
+import os
+import time
+from collections import Counter
+
+from config import PROFILE_PATH, TRACE_PATH
+
+ENABLED = bool(TRACE_PATH)
+
+_EVENTS = []
+_COUNTERS = Counter()
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, name: str, args):
+        import threading
+
+        self.event = {
+            "name": name,
+            "ph": "X",
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        self.event["ts"] = self.start // 1000
+        self.event["dur"] = (end - self.start) // 1000
+        _EVENTS.append(self.event)
+        return False
+
+
+def span(name: str, **args):
+    """Returns a context manager which records the time spent in it."""
+    if not ENABLED:
+        return _NOOP_SPAN
+    return _Span(name, args)
+
+
+def traced(name: str):
+    """Decorator which records a span for each call to the function."""
+
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        def wrapper(*args, **kwargs):
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, n: int = 1):
+    """Increments a counter, which is reported at the end of the trace."""
+    if ENABLED:
+        _COUNTERS[name] += n
+
+
+def write_trace():
+    """Writes the trace collected so far, and resets it for the next run."""
+    if not ENABLED:
+        return
+    import json
+
+    events = list(_EVENTS)
+    if events:
+        end = max(event["ts"] + event["dur"] for event in events)
+        events.append(
+            {
+                "name": "counters",
+                "ph": "C",
+                "ts": end,
+                "pid": os.getpid(),
+                "args": dict(_COUNTERS),
+            }
+        )
+    with open(TRACE_PATH, "w") as f:
+        json.dump({"traceEvents": events, "counters": dict(_COUNTERS)}, f)
+    _EVENTS.clear()
+    _COUNTERS.clear()
+
+
+class profile:
+    """Context manager which writes a cProfile dump if profiling is enabled."""
+
+    def __enter__(self):
+        self.profiler = None
+        if PROFILE_PATH:
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(PROFILE_PATH)
+        return False
@@ -0,0 +1,35 @@
+import json
+
+import tracing
+
+
+def test_disabled_tracing_is_a_noop(monkeypatch):
+    monkeypatch.setattr(tracing, "ENABLED", False)
+
+    def func():
+        pass
+
+    assert tracing.traced("func")(func) is func
+    assert tracing.span("a") is tracing.span("b")
+
+
+def test_write_trace(tmp_path, monkeypatch):
+    trace_path = str(tmp_path / "trace.json")
+    monkeypatch.setattr(tracing, "ENABLED", True)
+    monkeypatch.setattr(tracing, "TRACE_PATH", trace_path)
+
+    @tracing.traced("func")
+    def func():
+        tracing.count("calls")
+
+    with tracing.span("outer", arg="value"):
+        func()
+        func()
+    tracing.write_trace()
+
+    with open(trace_path) as f:
+        trace = json.load(f)
+    names = [event["name"] for event in trace["traceEvents"]]
+    assert names == ["func", "func", "outer", "counters"]
+    assert trace["traceEvents"][2]["args"] == {"arg": "value"}
+    assert trace["counters"] == {"calls": 2}
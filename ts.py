@@ -1,15 +1,57 @@
+import functools
 import os
+import re
 import shutil
-from typing import List, TypedDict
+import tempfile
+from typing import Dict, List, Tuple, TypedDict, Union
 
-from common import print_fix_details, readlines, sh_run, trim_suffix, writelines
+import background
+import tools
+import tracing
+from common import (
+    defer_batch,
+    file_edits,
+    print_fix_details,
+    readlines,
+    source_lines,
+    trim_prefix,
+    trim_suffix,
+    warn,
+)
+from config import WORKSPACE_DIRECTORY
+from negative_cache import entry_key, file_digest, is_unfixable, mark_unfixable
+from repo_files import is_ts_path, list_repo_files
+from repo_index import IndexRef, load_repo_index, repo_index_digest
 
 CANNOT_FIND_NAME_PATTERN = r"^(.*?):\d+:\d+.*?TS2304: Cannot find name \'(.*?)\'"
 MISSING_IMPORT_PATTERN = r"^(.*?):\d+:\d+.*?\[strictDeps\] transitive dependency on bazel-out/[^/]+?/bin/(.*?) not allowed."
 
+# Matches default and named imports, like `import a, { b, c } from "./d";`.
+# Namespace imports (`import * as a`) and side-effect imports are ignored.
+IMPORT_PATTERN = re.compile(
+    r"""^\s*import\s+(?:type\s+)?([\w$]+)?\s*,?\s*(?:\{([^}]*)\})?\s*"""
+    r"""from\s+["']([^"']+)["']""",
+    re.MULTILINE,
+)
+
+# Files tried, in order, when resolving a relative module specifier.
+MODULE_PATH_SUFFIXES = [".tsx", ".ts", "/index.tsx", "/index.ts"]
+
+# Bump this whenever the refs returned by import_refs_in_file change.
+IMPORT_INDEX_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def buildozer_path() -> Union[str, None]:
+    return shutil.which("buildozer")
+
+
+# (target to fix, dep to add) pairs, to be added in a single buildozer run.
+_PENDING_DEPS: Dict[Tuple[str, str], None] = {}
+
 
 def try_fix_import(file_path, imported_file_path):
-    if not shutil.which("buildozer"):
+    if not buildozer_path():
         return False
 
     # imported_file_path is relative to workspace root
@@ -19,26 +61,142 @@ def try_fix_import(file_path, imported_file_path):
     package_to_fix = os.path.dirname(file_path)
     target_to_fix = f"//{package_to_fix}"
 
-    sh_run(f'buildozer "add deps {imported_file_target}" {target_to_fix}')
-    print_fix_details(file_path, f"add dep {imported_file_target}")
+    defer_batch("buildozer", apply_dep_edits)
+    if (target_to_fix, imported_file_target) not in _PENDING_DEPS:
+        _PENDING_DEPS[(target_to_fix, imported_file_target)] = None
+        print_fix_details(file_path, f"add dep {imported_file_target}")
+
+
+def reset_dep_edits():
+    _PENDING_DEPS.clear()
+
+
+@tracing.traced("apply_dep_edits")
+def apply_dep_edits():
+    """Adds all pending deps using a single buildozer invocation."""
+    commands = "".join(f"add deps {dep}|{target}\n" for target, dep in _PENDING_DEPS)
+    _PENDING_DEPS.clear()
+    if not commands:
+        return
+    with tempfile.NamedTemporaryFile("w", suffix=".buildozer") as f:
+        f.write(commands)
+        f.flush()
+        result = tools.run(
+            tools.Command([buildozer_path(), "-f", f.name], capture=False)
+        )
+    # buildozer exits with code 3 if there was nothing to change.
+    if result.returncode not in (0, 3):
+        warn(f"buildozer failed with exit code {result.returncode}")
 
 
 class TsSymbol(TypedDict):
     name: str
+    # Workspace-relative file path, or package name if `package` is set.
     path: str
+    package: bool
     default: bool
 
 
-# TODO: Discover this list automatically using frequency analysis
-TS_SYMBOLS: List[TsSymbol] = [
-    {"name": x[0], "path": x[1], "default": x[2]}
-    for x in [
-        ("router", "app/router/router.tsx", True),
-        ("Checkbox", "app/components/checkbox/checkbox.tsx", True),
-    ]
-]
+def resolve_module_path(source_path: str, specifier: str) -> str:
+    """Resolves a module specifier to a workspace-relative file path, prefixed
+    with "//". Package specifiers are returned as-is."""
+    if not specifier.startswith("."):
+        return specifier
+    path = os.path.normpath(os.path.join(os.path.dirname(source_path), specifier))
+    for suffix in MODULE_PATH_SUFFIXES:
+        if os.path.isfile(path + suffix):
+            return "//" + path + suffix
+    return "//" + path
+
+
+def import_refs_in_file(path: str) -> List[IndexRef]:
+    """Returns (name, "<default|named> <module path>") for each imported name."""
+    if not is_ts_path(path):
+        return []
+    refs = []
+    for m in IMPORT_PATTERN.finditer("".join(readlines(path))):
+        default_name, named_imports, specifier = m.groups()
+        module_path = resolve_module_path(path, specifier)
+        if default_name:
+            refs.append((default_name, "default " + module_path))
+        for named_import in (named_imports or "").split(","):
+            name = trim_prefix(named_import.strip(), "type ").strip()
+            # Skip aliased imports, which can't be re-created from the alias.
+            if name and re.fullmatch(r"[\w$]+", name):
+                refs.append((name, "named " + module_path))
+    return refs
+
+
+def list_import_index_paths(repo_path: str) -> List[str]:
+    return list_repo_files(repo_path).ts_paths
+
+
+_TS_SYMBOLS: Union[Dict[str, TsSymbol], None] = None
+# Digest of the index that symbols were (or will be) loaded from.
+_TS_INDEX_DIGEST: Union[str, None] = None
 
 
+def ts_symbols() -> Dict[str, TsSymbol]:
+    """Returns the most commonly imported symbol for each name imported in the
+    workspace, loading the persistent TS import index on first use."""
+    global _TS_SYMBOLS
+    if _TS_SYMBOLS is None:
+        _TS_SYMBOLS = load_ts_symbols()
+    return _TS_SYMBOLS
+
+
+@tracing.traced("ts_symbols")
+def load_ts_symbols() -> Dict[str, TsSymbol]:
+    global _TS_INDEX_DIGEST
+    index = load_repo_index(
+        "ts_import_index",
+        IMPORT_INDEX_VERSION,
+        WORKSPACE_DIRECTORY,
+        list_import_index_paths,
+        import_refs_in_file,
+    )
+    _TS_INDEX_DIGEST = index.digest or None
+    symbols: Dict[str, TsSymbol] = {}
+    for name, value_count in index.value_count_by_key.items():
+        kind, module_path = value_count.most_common(1)[0][0].split(" ", 1)
+        is_package = not module_path.startswith("//")
+        symbols[name] = {
+            "name": name,
+            "path": module_path if is_package else module_path[2:],
+            "package": is_package,
+            "default": kind == "default",
+        }
+    return symbols
+
+
+def reset_ts_symbols():
+    """Forces symbols to be reloaded on next use, picking up any workspace
+    changes since they were last loaded."""
+    global _TS_SYMBOLS, _TS_INDEX_DIGEST
+    _TS_SYMBOLS = None
+    _TS_INDEX_DIGEST = None
+
+
+def prefetch_cannot_find_name(file_path, name):
+    """Starts loading the file missing the name, and symbols unless the name
+    is known to be unresolvable, in the background."""
+    background.submit(source_lines, file_path)
+    if _TS_SYMBOLS is None:
+        background.submit(_prefetch_ts_symbols, file_path, name)
+
+
+def _prefetch_ts_symbols(file_path, name):
+    # Like try_fix_cannot_find_name, skip names which a previous run couldn't
+    # resolve.
+    if _TS_SYMBOLS is not None:
+        return
+    unfixable_key = unresolved_name_key(file_path, name)
+    if unfixable_key and is_unfixable(unfixable_key, record_hit=False):
+        return
+    ts_symbols()
+
+
+@functools.lru_cache(maxsize=None)
 def resolve_import_path(source_path, import_path) -> str:
     rel_path_parts = []
     cur_dir = os.path.dirname(source_path)
@@ -50,31 +208,61 @@ def resolve_import_path(source_path, import_path) -> str:
         rel_path_parts.append(import_path[len(cur_dir + "/") :])
     else:
         rel_path_parts.append(import_path)
+    if rel_path_parts[0] != "..":
+        # Without this, the path would be interpreted as a package name.
+        rel_path_parts.insert(0, ".")
     out = "/".join(rel_path_parts)
     out = trim_suffix(out, ".tsx")
     out = trim_suffix(out, ".ts")
     return out
 
 
+def ts_index_digest() -> Union[str, None]:
+    """Returns a digest of the current TS import index, or None if it isn't
+    known without loading the index."""
+    global _TS_INDEX_DIGEST
+    if _TS_INDEX_DIGEST is None:
+        _TS_INDEX_DIGEST = repo_index_digest(
+            "ts_import_index", IMPORT_INDEX_VERSION, WORKSPACE_DIRECTORY
+        )
+    return _TS_INDEX_DIGEST
+
+
+def unresolved_name_key(file_path, name) -> Union[str, None]:
+    index_digest = ts_index_digest()
+    if index_digest is None:
+        return None
+    return entry_key("ts.cannot_find_name", file_digest(file_path), name, index_digest)
+
+
 def try_fix_cannot_find_name(file_path, name):
-    resolved_symbol = None
-    for symbol in TS_SYMBOLS:
-        if symbol["name"] == name:
-            resolved_symbol = symbol
-            break
+    # Skip names which couldn't be resolved by a previous run.
+    unfixable_key = unresolved_name_key(file_path, name)
+    if unfixable_key and is_unfixable(unfixable_key):
+        return False
+
+    resolved_symbol = ts_symbols().get(name)
     if not resolved_symbol:
+        unfixable_key = unresolved_name_key(file_path, name)
+        if unfixable_key:
+            mark_unfixable(unfixable_key)
         return False
 
-    import_path = resolve_import_path(file_path, resolved_symbol["path"])
+    if resolved_symbol["package"]:
+        import_path = resolved_symbol["path"]
+    else:
+        import_path = resolve_import_path(file_path, resolved_symbol["path"])
 
-    lines = readlines(file_path)
+    lines = source_lines(file_path)
     for (i, line) in enumerate(lines):
         if "React" in line:
             # React import comes first.
             continue
-        import_line = f'import {name} from "{import_path}";\n'
-        out_lines = [*lines[:i], import_line, *lines[i:]]
-        writelines(file_path, out_lines)
+        if resolved_symbol["default"]:
+            import_line = f'import {name} from "{import_path}";\n'
+        else:
+            import_line = f'import {{ {name} }} from "{import_path}";\n'
+        file_edits(file_path).insert(i + 1, import_line)
         print_fix_details(file_path, f"add import '{name}'")
         return True
 
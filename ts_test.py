@@ -0,0 +1,121 @@
+import os
+import subprocess
+import threading
+
+import background
+import cache
+import common
+import negative_cache
+import tools
+import ts
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_try_fix_cannot_find_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(common, "WORKSPACE_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(ts, "WORKSPACE_DIRECTORY", str(tmp_path))
+    ts.reset_ts_symbols()
+    _write(f"{tmp_path}/app/router/router.tsx", "export default {};\n")
+    _write(f"{tmp_path}/app/util/format.ts", "export function percent() {}\n")
+    _write(
+        f"{tmp_path}/app/a/a.tsx",
+        'import React from "react";\n'
+        'import router from "../router/router";\n'
+        "import {\n  percent,\n  type Thing,\n  other as alias,\n} from "
+        '"../util/format";\n',
+    )
+    _write(
+        f"{tmp_path}/app/b/b.tsx",
+        'import router from "../router/router";\nimport { percent } from "lodash";\n',
+    )
+    subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+    _write(f"{tmp_path}/app/c/c.tsx", 'import React from "react";\n\nrouter;\n')
+    monkeypatch.chdir(tmp_path)
+
+    assert ts.try_fix_cannot_find_name("app/c/c.tsx", "router")
+    assert ts.try_fix_cannot_find_name("app/c/c.tsx", "percent")
+    assert not ts.try_fix_cannot_find_name("app/c/c.tsx", "alias")
+    common.apply_edits()
+
+    assert common.readlines("app/c/c.tsx") == [
+        'import React from "react";\n',
+        'import router from "../router/router";\n',
+        'import { percent } from "../util/format";\n',
+        "\n",
+        "router;\n",
+    ]
+
+
+def test_resolve_import_path():
+    assert ts.resolve_import_path("app/a/a.tsx", "app/b/b.tsx") == "../b/b"
+    assert ts.resolve_import_path("app/a/a.tsx", "app/a/b.ts") == "./b"
+
+
+def test_try_fix_import_batches_buildozer_runs(tmp_path, monkeypatch):
+    commands = []
+
+    def fake_run(command):
+        assert command.args[:2] == ["/bin/buildozer", "-f"]
+        with open(command.args[2]) as f:
+            commands.append(f.read())
+        return tools.Result(command, 3)
+
+    monkeypatch.setattr(ts, "buildozer_path", lambda: "/bin/buildozer")
+    monkeypatch.setattr(tools, "run", fake_run)
+    common.reset_source_files()
+    ts.reset_dep_edits()
+
+    ts.try_fix_import("app/a/a.tsx", "app/b/b.d.ts")
+    ts.try_fix_import("app/a/a_test.tsx", "app/b/b.d.ts")
+    ts.try_fix_import("app/c/c.tsx", "app/b/b.d.ts")
+    assert commands == []
+    common.apply_edits()
+    assert commands == ["add deps //app/b|//app/a\nadd deps //app/b|//app/c\n"]
+
+    common.apply_edits()
+    assert len(commands) == 1
+
+    # Deps queued before the batches were reset are still applied.
+    ts.try_fix_import("app/a/a.tsx", "app/b/b.d.ts")
+    common.reset_source_files()
+    ts.try_fix_import("app/c/c.tsx", "app/b/b.d.ts")
+    common.apply_edits()
+    assert commands[1] == "add deps //app/b|//app/a\nadd deps //app/b|//app/c\n"
+
+
+def test_prefetch_skips_unresolvable_names(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(ts, "_TS_SYMBOLS", None)
+    monkeypatch.setattr(ts, "ts_index_digest", lambda: "digest")
+    negative_cache.reset_negative_cache()
+    a, b = str(tmp_path / "a.ts"), str(tmp_path / "b.ts")
+    _write(a, "const a = x;\n")
+    _write(b, "const b = x;\n")
+    negative_cache.mark_unfixable(ts.unresolved_name_key(b, "x"))
+    loaded_on_threads = []
+    symbols = {"x": {"name": "x", "path": "x", "package": True, "default": False}}
+
+    def fake_load_ts_symbols():
+        loaded_on_threads.append(threading.get_ident())
+        return symbols
+
+    monkeypatch.setattr(ts, "load_ts_symbols", fake_load_ts_symbols)
+
+    ts.prefetch_cannot_find_name(b, "x")
+    background.wait()
+    assert loaded_on_threads == []
+
+    ts.prefetch_cannot_find_name(a, "x")
+    ts.prefetch_cannot_find_name(a, "x")
+    background.wait()
+
+    assert ts.ts_symbols() is symbols
+    assert len(loaded_on_threads) == 1
+    assert loaded_on_threads[0] != threading.get_ident()
+    negative_cache.reset_negative_cache()
@@ -1,9 +1,24 @@
+import ast
+import functools
+import json
 import os
-import re
-from typing import TypedDict, Union
+from dataclasses import dataclass
+from typing import Any, Dict, List, Set, Tuple, TypedDict, Union
 
-from common import readlines
-from config import INTERNAL_REPO_PATH, OSS_PREFIX, OSS_REPO_PATH, WORKSPACE_DIRECTORY
+import tracing
+from cache import cache_path, read_json, write_json
+from common import readlines, warn
+from config import (
+    INTERNAL_REPO_PATH,
+    OSS_PREFIX,
+    OSS_REPO_PATH,
+    PERSIST_BUILD_INDEX,
+    WORKSPACE_DIRECTORY,
+    WORKSPACES_CONFIG,
+)
+
+# Bump this whenever the format of the on-disk BUILD index changes.
+BUILD_INDEX_VERSION = 1
 
 
 class SourceFileInfo(TypedDict):
@@ -19,98 +34,251 @@ def guess_package(path: str) -> str:
     return pkg
 
 
+def parse_BUILD_targets(content: str) -> Dict[str, str]:
+    """Returns a map from each src file listed in a BUILD file to the name of
+    the first target that lists it.
+
+    BUILD files are parsed as Python syntax, and only literal `name` and
+    `srcs` attributes are evaluated, so targets using `glob` etc. are skipped.
+    """
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError):
+        return {}
+    targets = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        attrs = {kw.arg: kw.value for kw in node.keywords if kw.arg}
+        if "name" not in attrs or "srcs" not in attrs:
+            continue
+        try:
+            name = ast.literal_eval(attrs["name"])
+            srcs = ast.literal_eval(attrs["srcs"])
+        except (ValueError, TypeError, SyntaxError):
+            continue
+        if not isinstance(name, str) or not isinstance(srcs, (list, tuple)):
+            continue
+        for src in srcs:
+            if isinstance(src, str):
+                targets.setdefault(src.lstrip(":"), name)
+    return targets
+
+
+# BUILD file path -> parsed targets, for BUILD files seen by this process.
+_BUILD_TARGETS: Dict[str, Dict[str, str]] = {}
+# Repo path -> persisted BUILD file entries of the repo, loaded on first use.
+# Each repo is stored separately, so that a change in one doesn't rewrite the
+# entries of the others.
+_BUILD_INDEXES: Dict[str, Dict[str, Any]] = {}
+# Repo paths whose entries changed since they were loaded.
+_CHANGED_BUILD_INDEXES: Set[str] = set()
+
+
+def _BUILD_index_path(repo_path: str) -> str:
+    return cache_path("build_index", os.path.realpath(repo_path))
+
+
+def _persisted_BUILD_index(repo_path: str) -> Dict[str, Any]:
+    if repo_path not in _BUILD_INDEXES:
+        index = {}
+        if PERSIST_BUILD_INDEX:
+            value = read_json(_BUILD_index_path(repo_path))
+            if value and value.get("version") == BUILD_INDEX_VERSION:
+                index = value["files"]
+        _BUILD_INDEXES[repo_path] = index
+    return _BUILD_INDEXES[repo_path]
+
+
+def BUILD_targets(repo_path: str, build_file_path: str) -> Dict[str, str]:
+    """Returns the parsed targets for a BUILD file in the given repo, parsing
+    it at most once.
+
+    Parsed targets are persisted across runs, and re-parsed only if the BUILD
+    file's mtime changed.
+    """
+    if build_file_path in _BUILD_TARGETS:
+        return _BUILD_TARGETS[build_file_path]
+    try:
+        mtime_ns = os.stat(build_file_path).st_mtime_ns
+    except FileNotFoundError:
+        targets = {}
+    else:
+        index = _persisted_BUILD_index(repo_path)
+        entry = index.get(build_file_path)
+        if entry and entry["mtime_ns"] == mtime_ns:
+            targets = entry["targets"]
+        else:
+            tracing.count("BUILD_files_parsed")
+            targets = parse_BUILD_targets("".join(readlines(build_file_path)))
+            index[build_file_path] = {"mtime_ns": mtime_ns, "targets": targets}
+            _CHANGED_BUILD_INDEXES.add(repo_path)
+    _BUILD_TARGETS[build_file_path] = targets
+    return targets
+
+
+def reset_BUILD_targets():
+    """Forces BUILD files to be re-validated against the persisted index on
+    next use."""
+    _BUILD_TARGETS.clear()
+    _SOURCE_FILE_INFO.clear()
+
+
+def save_BUILD_index():
+    """Writes the entries of each repo whose entries changed, dropping those
+    of BUILD files which no longer exist."""
+    if not PERSIST_BUILD_INDEX:
+        _CHANGED_BUILD_INDEXES.clear()
+        return
+    for repo_path in sorted(_CHANGED_BUILD_INDEXES):
+        index = _BUILD_INDEXES[repo_path]
+        for build_file_path in [path for path in index if not os.path.exists(path)]:
+            del index[build_file_path]
+        write_json(
+            _BUILD_index_path(repo_path),
+            {"version": BUILD_INDEX_VERSION, "files": index},
+        )
+    _CHANGED_BUILD_INDEXES.clear()
+
+
 def guess_go_target(repo_path: str, relative_file_path: str) -> str:
     build_file_path = os.path.join(
         repo_path, os.path.dirname(relative_file_path), "BUILD"
     )
     basename = os.path.basename(relative_file_path)
-    target_name = basename.split(".")[0]
-
-    # TODO: more robust logic here.
-    if os.path.exists(build_file_path):
-        build_lines = readlines(build_file_path)
-        cur_name = ""
-        cur_srcs = []
-        for line in build_lines:
-            try:
-                if m := re.search(r"name\s*=\s*(.*?),", line):
-                    cur_name = eval(m.group(1))
-                if m := re.search(r"srcs\s*=\s*(\[.*\])", line):
-                    cur_srcs = eval(m.group(1))
-            except:
-                continue
-
-            if basename in cur_srcs:
-                target_name = cur_name
-                break
-
+    target_name = BUILD_targets(repo_path, build_file_path).get(
+        basename, basename.split(".")[0]
+    )
     return f"//{os.path.dirname(relative_file_path)}:{target_name}"
 
 
-def get_source_file_info_from_sandbox_path(
-    sandbox_file_path,
-) -> Union[SourceFileInfo, None]:
-    execroot_relative_path = re.sub(".*?execroot/", "", sandbox_file_path)
-    (workspace_name, workspace_relative_path) = execroot_relative_path.split(
-        "/", maxsplit=1
-    )
-    if workspace_relative_path.startswith(OSS_PREFIX):
-        repo_path = OSS_REPO_PATH
-        workspace_name = "buildbuddy"
-        workspace_relative_path = workspace_relative_path[len(OSS_PREFIX) :]
-    elif workspace_name == "buildbuddy" and not workspace_relative_path.startswith(
-        "external/"
-    ):
-        repo_path = OSS_REPO_PATH
-    elif (
-        workspace_name == "buildbuddy_internal"
-        and not workspace_relative_path.startswith("external/")
-    ):
-        repo_path = INTERNAL_REPO_PATH
-    else:
-        return None
+@dataclass(frozen=True)
+class Workspace:
+    # The bazel workspace name, as in `execroot/<name>/`.
+    name: str
+    # Path to the local checkout.
+    path: str
+    # Name of the directory under `external/` which other workspaces see this
+    # one as, if they depend on it.
+    external_repo: Union[str, None] = None
+
+
+def default_workspaces() -> List[Workspace]:
+    workspaces = []
+    if OSS_REPO_PATH:
+        workspaces.append(
+            Workspace("buildbuddy", OSS_REPO_PATH, OSS_PREFIX.split("/")[1])
+        )
+    if INTERNAL_REPO_PATH:
+        workspaces.append(Workspace("buildbuddy_internal", INTERNAL_REPO_PATH))
+    return workspaces
+
+
+@functools.lru_cache(maxsize=None)
+def configured_workspaces() -> List[Workspace]:
+    """Returns the workspaces declared in WORKSPACES_CONFIG, or the BuildBuddy
+    repos configured via env vars if there is no such file.
+
+    The config file is a JSON list of objects with "name", "path" and
+    optionally "external_repo" fields.
+    """
+    try:
+        with open(WORKSPACES_CONFIG, "r") as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return default_workspaces()
+    except (OSError, ValueError) as e:
+        warn(f"Failed to read {WORKSPACES_CONFIG}: {e}")
+        return default_workspaces()
+    workspaces = []
+    for entry in entries:
+        try:
+            workspaces.append(
+                Workspace(
+                    name=entry["name"],
+                    path=os.path.abspath(os.path.expanduser(entry["path"])),
+                    external_repo=entry.get("external_repo"),
+                )
+            )
+        except (KeyError, TypeError):
+            warn(f"Invalid workspace in {WORKSPACES_CONFIG}: {entry!r}")
+    return workspaces
 
-    # TODO: handle non-Go srcs
-    target = guess_go_target(
-        repo_path=repo_path, relative_file_path=workspace_relative_path
-    )
-    return {
-        "workspace_name": workspace_name,
-        "workspace_path": repo_path,
-        "workspace_relative_path": workspace_relative_path,
-        "realpath": os.path.join(repo_path, workspace_relative_path),
-        "target": target,
-    }
 
+class PathResolver:
+    """Maps paths in bazel output to the workspaces containing them."""
 
+    def __init__(self, workspaces: List[Workspace], workspace_directory: str):
+        self.by_name = {ws.name: ws for ws in workspaces}
+        self.by_external_repo = {
+            ws.external_repo: ws for ws in workspaces if ws.external_repo
+        }
+        # The workspace that bazel was run in, which relative paths in its
+        # output are relative to. If workspaces are nested, the innermost one
+        # is used.
+        self.current = None
+        for ws in workspaces:
+            if (workspace_directory + "/").startswith(ws.path.rstrip("/") + "/"):
+                if self.current is None or len(ws.path) > len(self.current.path):
+                    self.current = ws
+
+    def resolve(self, path: str) -> Union[Tuple[Workspace, str], None]:
+        """Returns the workspace containing the given path, along with the
+        path relative to the workspace root."""
+        execroot = path.find("/execroot/")
+        if execroot >= 0:
+            # e.g. /.../execroot/<workspace name>/<relative path>
+            parts = path[execroot + len("/execroot/") :].split("/", 1)
+            if len(parts) < 2:
+                return None
+            name, path = parts
+            if not path.startswith("external/"):
+                ws = self.by_name.get(name)
+                return (ws, path) if ws else None
+        elif not path.startswith("external/"):
+            if self.current is None:
+                return None
+            if not os.path.exists(os.path.join(self.current.path, path)):
+                return None
+            return self.current, path
+        # e.g. external/<repo>/<relative path>
+        parts = path.split("/", 2)
+        if len(parts) < 3:
+            return None
+        ws = self.by_external_repo.get(parts[1])
+        return (ws, parts[2]) if ws else None
+
+
+@functools.lru_cache(maxsize=None)
+def path_resolver() -> PathResolver:
+    return PathResolver(configured_workspaces(), WORKSPACE_DIRECTORY)
+
+
+# The same file is usually referenced by several errors, so lookups are
+# memoized until reset_BUILD_targets is called.
+_SOURCE_FILE_INFO: Dict[str, Union[SourceFileInfo, None]] = {}
+
+
+@tracing.traced("get_source_file_info")
 def get_source_file_info(path: str) -> Union[SourceFileInfo, None]:
-    if "/execroot/" in path:
-        return get_source_file_info_from_sandbox_path(path)
-    if path.startswith(OSS_PREFIX):
-        repo_path = OSS_REPO_PATH
-        workspace_name = "buildbuddy"
-        workspace_relative_path = path[len(OSS_PREFIX) :]
-    elif WORKSPACE_DIRECTORY.startswith(OSS_REPO_PATH) and os.path.exists(
-        os.path.join(OSS_REPO_PATH, path)
-    ):
-        repo_path = OSS_REPO_PATH
-        workspace_name = "buildbuddy"
-        workspace_relative_path = path
-    elif WORKSPACE_DIRECTORY.startswith(INTERNAL_REPO_PATH) and os.path.exists(
-        os.path.join(INTERNAL_REPO_PATH, path)
-    ):
-        repo_path = INTERNAL_REPO_PATH
-        workspace_name = "buildbuddy_internal"
-        workspace_relative_path = path
-    else:
+    if path not in _SOURCE_FILE_INFO:
+        _SOURCE_FILE_INFO[path] = _get_source_file_info(path)
+    return _SOURCE_FILE_INFO[path]
+
+
+def _get_source_file_info(path: str) -> Union[SourceFileInfo, None]:
+    resolved = path_resolver().resolve(path)
+    if resolved is None:
         return None
+    ws, workspace_relative_path = resolved
+    # TODO: handle non-Go srcs
     target = guess_go_target(
-        repo_path=repo_path, relative_file_path=workspace_relative_path
+        repo_path=ws.path, relative_file_path=workspace_relative_path
     )
     return {
-        "workspace_name": workspace_name,
-        "workspace_path": repo_path,
+        "workspace_name": ws.name,
+        "workspace_path": ws.path,
         "workspace_relative_path": workspace_relative_path,
-        "realpath": os.path.join(repo_path, workspace_relative_path),
+        "realpath": os.path.join(ws.path, workspace_relative_path),
         "target": target,
     }
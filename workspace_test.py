@@ -0,0 +1,117 @@
+import os
+
+import cache
+import workspace
+
+BUILD_FILE = """load("@io_bazel_rules_go//go:def.bzl", "go_library", "go_test")
+
+go_library(
+    name = "foo",
+    srcs = [
+        "foo.go",
+        ":bar.go",
+    ],
+    importpath = "example.com/foo",
+)
+
+go_test(
+    name = "foo_test",
+    srcs = ["foo_test.go"] + glob(["testdata/*.go"]),
+)
+
+go_test(
+    name = "bar_test",
+    srcs = ["bar_test.go", "foo.go"],
+)
+"""
+
+
+def test_parse_BUILD_targets():
+    assert workspace.parse_BUILD_targets(BUILD_FILE) == {
+        "foo.go": "foo",
+        "bar.go": "foo",
+        "bar_test.go": "bar_test",
+    }
+
+
+def test_guess_go_target(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(workspace, "_BUILD_TARGETS", {})
+    monkeypatch.setattr(workspace, "_BUILD_INDEXES", {})
+    monkeypatch.setattr(workspace, "_CHANGED_BUILD_INDEXES", set())
+    os.makedirs(tmp_path / "pkg")
+    with open(tmp_path / "pkg" / "BUILD", "w") as f:
+        f.write(BUILD_FILE)
+
+    for _ in range(2):
+        assert workspace.guess_go_target(str(tmp_path), "pkg/bar.go") == "//pkg:foo"
+        assert (
+            workspace.guess_go_target(str(tmp_path), "pkg/foo_test.go")
+            == "//pkg:foo_test"
+        )
+    workspace.save_BUILD_index()
+
+    # Targets are loaded from the persisted index without re-parsing.
+    monkeypatch.setattr(workspace, "_BUILD_TARGETS", {})
+    monkeypatch.setattr(workspace, "_BUILD_INDEXES", {})
+    parse_BUILD_targets = workspace.parse_BUILD_targets
+    monkeypatch.setattr(workspace, "parse_BUILD_targets", None)
+    assert workspace.guess_go_target(str(tmp_path), "pkg/bar.go") == "//pkg:foo"
+
+    # Entries of BUILD files which were deleted are dropped on the next save.
+    monkeypatch.setattr(workspace, "parse_BUILD_targets", parse_BUILD_targets)
+    os.makedirs(tmp_path / "new")
+    (tmp_path / "new" / "BUILD").write_text(BUILD_FILE)
+    os.remove(tmp_path / "pkg" / "BUILD")
+    assert workspace.guess_go_target(str(tmp_path), "new/bar.go") == "//new:foo"
+    workspace.save_BUILD_index()
+    monkeypatch.setattr(workspace, "_BUILD_INDEXES", {})
+    assert list(workspace._persisted_BUILD_index(str(tmp_path))) == [
+        str(tmp_path / "new" / "BUILD")
+    ]
+    # Each repo is stored separately.
+    assert workspace._persisted_BUILD_index(str(tmp_path / "other")) == {}
+
+
+def test_configured_workspaces(tmp_path, monkeypatch):
+    config = tmp_path / "workspaces.json"
+    config.write_text(
+        '[{"name": "oss", "path": "/src/oss", "external_repo": "com_example_oss"},'
+        ' {"name": "internal", "path": "/src/internal"}]'
+    )
+    monkeypatch.setattr(workspace, "WORKSPACES_CONFIG", str(config))
+    workspace.configured_workspaces.cache_clear()
+    try:
+        assert workspace.configured_workspaces() == [
+            workspace.Workspace("oss", "/src/oss", "com_example_oss"),
+            workspace.Workspace("internal", "/src/internal"),
+        ]
+    finally:
+        workspace.configured_workspaces.cache_clear()
+
+
+def test_path_resolver(tmp_path):
+    oss = workspace.Workspace("oss", str(tmp_path / "oss"), "com_example_oss")
+    internal = workspace.Workspace("internal", str(tmp_path / "internal"))
+    tools = workspace.Workspace("tools", str(tmp_path / "tools"), "tools_repo")
+    os.makedirs(tmp_path / "internal" / "app")
+    (tmp_path / "internal" / "app" / "a.go").write_text("package app\n")
+    resolver = workspace.PathResolver(
+        [oss, internal, tools], str(tmp_path / "internal" / "app")
+    )
+    execroot = "/home/u/.cache/bazel/_bazel_u/123/sandbox/linux-sandbox/7/execroot"
+
+    assert resolver.resolve(f"{execroot}/oss/server/a.go") == (oss, "server/a.go")
+    assert resolver.resolve(f"{execroot}/internal/external/com_example_oss/b.go") == (
+        oss,
+        "b.go",
+    )
+    assert resolver.resolve(f"{execroot}/internal/external/tools_repo/c/c.go") == (
+        tools,
+        "c/c.go",
+    )
+    assert resolver.resolve(f"{execroot}/internal/external/other/c.go") is None
+    assert resolver.resolve(f"{execroot}/unknown/c.go") is None
+    assert resolver.resolve("external/com_example_oss/d.go") == (oss, "d.go")
+    assert resolver.resolve("app/a.go") == (internal, "app/a.go")
+    assert resolver.resolve("app/missing.go") is None